@@ -0,0 +1,137 @@
+
+import glob
+import os
+import sys
+import time
+from multiprocessing import Pool
+from decoder import *
+
+def collectFiles(inputs: list, listPath: str = None):
+    # Directories contribute their .jpg/.jpeg files, patterns are globbed,
+    # anything else is taken as a path; listPath adds one path per line
+    fpaths = []
+    for arg in inputs:
+        if os.path.isdir(arg):
+            fpaths += sorted(os.path.join(arg, name) for name in os.listdir(arg)
+                             if name.lower().endswith(('.jpg', '.jpeg')))
+        elif glob.has_magic(arg):
+            fpaths += sorted(glob.glob(arg))
+        else:
+            fpaths.append(arg)
+
+    if listPath is not None:
+        f = sys.stdin if listPath == '-' else open(listPath)
+        fpaths += [line.strip() for line in f if line.strip()]
+        if f is not sys.stdin:
+            f.close()
+
+    return fpaths
+
+def outputPaths(fpaths: list, outdir: str):
+    # Each input's path relative to the deepest directory holding them all,
+    # mirrored under outdir with a .bmp extension
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(fpath)) for fpath in fpaths])
+    outpaths = [os.path.join(outdir, os.path.splitext(os.path.relpath(os.path.abspath(fpath), root))[0] + '.bmp')
+                for fpath in fpaths]
+
+    seen = {}
+    for fpath, outpath in zip(fpaths, outpaths):
+        assert outpath not in seen, f'Error - {fpath} and {seen[outpath]} would both be written to {outpath}'
+        seen[outpath] = fpath
+    return outpaths
+
+# Per-process decode options, set once by the pool initializer
+batchOptions: dict = {}
+
+def initBatchWorker(options: dict):
+    global batchOptions
+    batchOptions = options
+
+def decodeFile(job: tuple):
+    # job: (fpath, BMP path or None); returns (fpath, seconds, input bytes, error or None)
+    fpath, outpath = job
+    start = time.perf_counter()
+    size = 0
+    error = None
+    try:
+        size = os.path.getsize(fpath)
+        image = readJPG(fpath, idct=batchOptions['idct'], fractionBits=batchOptions['fractionBits'],
+                        cspace=batchOptions['cspace'], scale=batchOptions['scale'])
+
+        if outpath is not None:
+            os.makedirs(os.path.dirname(outpath), exist_ok=True)
+            Bmp().writeBMP(image, outpath)
+    except Exception as e:
+        # Any failure, malformed input or not, is reported for this file
+        # instead of aborting the batch
+        error = str(e) or type(e).__name__
+
+    return fpath, time.perf_counter() - start, size, error
+
+def runBatch(fpaths: list, options: dict, workers: int, chunksize: int = None, ordered: bool = True,
+             verbose: bool = True):
+    # Decodes fpaths across a process pool, printing each file's latency
+    # (verbose) and the totals; returns the per-file results
+    if chunksize is None:
+        chunksize = max(1, len(fpaths) // (4 * workers))
+
+    outdir = options['outdir']
+    outpaths = outputPaths(fpaths, outdir) if outdir is not None else [None] * len(fpaths)
+
+    results = []
+    start = time.perf_counter()
+    with Pool(workers, initializer=initBatchWorker, initargs=(options,)) as pool:
+        mapper = pool.imap if ordered else pool.imap_unordered
+        for fpath, seconds, size, error in mapper(decodeFile, zip(fpaths, outpaths), chunksize=chunksize):
+            results.append((fpath, seconds, size, error))
+            if verbose:
+                if error is None:
+                    print(f'{fpath}: {seconds * 1000:.1f} ms')
+                else:
+                    print(f'{fpath}: failed after {seconds * 1000:.1f} ms - {error}')
+    elapsed = time.perf_counter() - start
+
+    decoded = [r for r in results if r[3] is None]
+    megabytes = sum(r[2] for r in decoded) / (1 << 20)
+    meanLatency = sum(r[1] for r in decoded) / max(1, len(decoded))
+    print(f'{len(decoded)} decoded, {len(results) - len(decoded)} failed in {elapsed:.2f} s: '
+          f'{len(decoded) / elapsed:.1f} images/s, {megabytes / elapsed:.2f} MB/s, '
+          f'mean latency {meanLatency * 1000:.1f} ms')
+
+    return results
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', nargs='*', help='files, directories or glob patterns')
+    parser.add_argument('-l', '--list', dest='listPath', metavar='FILE',
+                        help='newline-delimited list of files, - for stdin')
+    parser.add_argument('-o', '--outdir',
+                        help='write a BMP per file into this directory, mirroring the input directories')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='decoder processes')
+    parser.add_argument('--chunksize', type=int,
+                        help='files handed to a worker at a time')
+    parser.add_argument('--unordered', action='store_true',
+                        help='report files as they complete instead of in input order')
+    parser.add_argument('--idct', choices=['numpy', 'scalar'], default='numpy')
+    parser.add_argument('--fixed-point', type=int, metavar='F', dest='fractionBits')
+    parser.add_argument('--cspace', choices=['numpy', 'fixed', 'scalar'], default='numpy')
+    parser.add_argument('--scale', type=int, choices=[1, 2, 4, 8], default=1)
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='only print the totals')
+    args = parser.parse_args()
+
+    fpaths = collectFiles(args.inputs, args.listPath)
+    assert fpaths, 'Error - No input files'
+
+    if args.outdir is not None:
+        os.makedirs(args.outdir, exist_ok=True)
+
+    options = { 'idct': args.idct, 'fractionBits': args.fractionBits, 'cspace': args.cspace,
+                'scale': args.scale, 'outdir': args.outdir }
+
+    results = runBatch(fpaths, options, args.workers, args.chunksize, not args.unordered, not args.quiet)
+
+    exit(1 if any(r[3] is not None for r in results) else 0)
@@ -0,0 +1,235 @@
+
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import numpy as np
+from decoder import *
+from encoder import *
+
+def syntheticInputs(source: str, tiles: list, restartIntervals: list, directory: str):
+    # The source's quantized coefficients tiled n x n, re-encoded with each
+    # restart interval; returns [(name, fpath)]
+    with Bitreader(source) as br:
+        decoder = Decoder(br)
+        decoder.readFrameHeader()
+        image = decoder.image
+        image.allocatePlanes()
+        decoder.readScans()
+    assert image.horizontalSamplingFactor == 1 and image.verticalSamplingFactor == 1, \
+        'Error - Synthetic inputs need a 1x1 sampled source'
+
+    planes = [image.colorComponents[i].coeffs for i in range(image.numComponents)]
+    qTables = [qTable.table for qTable in decoder.quant.componentTables(image)]
+
+    inputs = []
+    for n in tiles:
+        tiled = [np.tile(plane, (n, n, 1)) for plane in planes]
+        rows, cols = tiled[0].shape[:2]
+        for restartInterval in restartIntervals:
+            name = f'synthetic-{cols * 8}x{rows * 8}-ri{restartInterval}'
+            fpath = os.path.join(directory, name + '.jpg')
+            with open(fpath, 'wb') as f:
+                f.write(encodeCoefficients(tiled, [(1, 1)] * len(tiled), qTables, list(range(len(tiled))),
+                                           rows * 8, cols * 8, restartInterval))
+                f.close()
+            inputs.append((name, fpath))
+    return inputs
+
+def timeStage(fn, repeat: int, setup=None):
+    # Median wall time of fn over repeat runs, setup excluded
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def stageResult(seconds: float, count: float, unit: str):
+    return { 'seconds': seconds, 'rate': count / seconds, 'unit': unit }
+
+def symbolStream(numSymbols: int):
+    # AC symbols drawn with probability 2^-length, as a Huffman code
+    # expects, encoded back to back; returns (data, DHT payload)
+    codes = huffmanCodes(AC_LUMINANCE_BITS, AC_LUMINANCE_VALUES)
+    symbols = list(codes)
+    weights = np.array([2.0 ** -len(codes[s]) for s in symbols])
+    rng = np.random.default_rng(0)
+    drawn = rng.choice(len(symbols), numSymbols, p=weights / weights.sum())
+    s = ''.join(codes[symbols[k]] for k in drawn)
+    s += '1' * (-len(s) % 8)
+    return int(s, 2).to_bytes(len(s) // 8, 'big').replace(b'\xff', b'\xff\x00'), \
+        huffmanSegment(0x10, AC_LUMINANCE_BITS, AC_LUMINANCE_VALUES)[2:]
+
+def benchSymbols(numSymbols: int, repeat: int):
+    data, segment = symbolStream(numSymbols)
+    huff = HuffmanDecoder(Bitreader.fromBytes(segment))
+    huff.readHuffmanTable()
+    acTable = huff.acTables[0]
+
+    def decode():
+        for _ in range(numSymbols):
+            huff.getNextSymbol(acTable)
+
+    def setup():
+        huff.br = Bitreader.fromBytes(data)
+
+    return stageResult(timeStage(decode, repeat, setup), numSymbols, 'symbols/s')
+
+def benchTables(repeat: int):
+    # DHT setup of the Annex K DC and AC tables, built and from the table cache
+    segment = huffmanSegment(0x00, DC_LUMINANCE_BITS, DC_LUMINANCE_VALUES)[4:] + \
+        huffmanSegment(0x10, AC_LUMINANCE_BITS, AC_LUMINANCE_VALUES)[4:]
+    segment = (len(segment) + 2).to_bytes(2, 'big') + segment
+    huff = HuffmanDecoder(None)
+
+    def setup():
+        huff.br = Bitreader.fromBytes(segment)
+
+    def setupCold():
+        setup()
+        tableCache.clear()
+
+    return {
+        'readHuffmanTable': stageResult(timeStage(huff.readHuffmanTable, repeat, setupCold), 2, 'tables/s'),
+        'readHuffmanTable (hit)': stageResult(timeStage(huff.readHuffmanTable, repeat, setup), 2, 'tables/s'),
+    }
+
+def benchInput(fpath: str, repeat: int):
+    results = {}
+    fileSize = os.path.getsize(fpath)
+    index = buildIndex(fpath)
+    entropyBytes = index.segmentEnd - index.scanStart
+
+    def readAllBits():
+        with Bitreader(fpath) as br:
+            br.seek(index.scanStart)
+            while br.hasBits():
+                br.readBits(8)
+
+    results['Bitreader'] = stageResult(timeStage(readAllBits, repeat), entropyBytes / (1 << 20), 'MB/s')
+
+    decoder = Decoder(Bitreader(fpath))
+    decoder.readFrameHeader()
+    image = decoder.image
+    image.allocatePlanes()
+    decoder.readStartOfScan()
+    blocks = sum(image.colorComponents[i].coeffs.shape[0] * image.colorComponents[i].coeffs.shape[1]
+                 for i in range(image.numComponents))
+
+    def resetScan():
+        decoder.br.seek(index.scanStart)
+        for i in range(image.numComponents):
+            image.colorComponents[i].coeffs.fill(0)
+
+    results['decodeBlockComponent'] = stageResult(
+        timeStage(lambda: decoder.huff.decodeHuffmanData(image), repeat, resetScan), blocks, 'blocks/s')
+    decoder.br.close()
+
+    results['dequantize'] = stageResult(
+        timeStage(lambda: decoder.quant.dequantize(image), repeat), blocks, 'blocks/s')
+
+    results['inverseDCT'] = stageResult(
+        timeStage(lambda: decoder.dct.inverseDCT(image), repeat, lambda: decoder.quant.dequantize(image)),
+        blocks, 'blocks/s')
+
+    pixels = image.height * image.width / 1e6
+    results['YCbCrToRGB'] = stageResult(
+        timeStage(lambda: decoder.cspace.YCbCrToRGB(image), repeat), pixels, 'Mpixels/s')
+
+    with tempfile.TemporaryDirectory() as directory:
+        outpath = os.path.join(directory, 'out.bmp')
+        results['writeBMP'] = stageResult(
+            timeStage(lambda: Bmp().writeBMP(image, outpath), repeat), pixels, 'Mpixels/s')
+
+    results['readJPG'] = stageResult(
+        timeStage(lambda: readJPG(fpath), repeat), fileSize / (1 << 20), 'MB/s')
+
+    return results
+
+def runBenchmarks(source: str, tiles: list, restartIntervals: list, repeat: int, numSymbols: int):
+    report = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'repeat': repeat,
+        'inputs': {},
+    }
+
+    report['inputs']['symbols'] = { 'getNextSymbol': benchSymbols(numSymbols, repeat) }
+    report['inputs']['symbols'].update(benchTables(repeat))
+
+    name = os.path.splitext(os.path.basename(source))[0]
+    report['inputs'][name] = benchInput(source, repeat)
+    print(f'{name}: done', file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, fpath in syntheticInputs(source, tiles, restartIntervals, directory):
+            report['inputs'][name] = benchInput(fpath, repeat)
+            print(f'{name}: done', file=sys.stderr)
+
+    return report
+
+def compareReports(baseline: dict, current: dict, threshold: float):
+    # Stages whose median time grew by more than threshold (0.1 = 10%)
+    regressions = []
+    for name, stages in current['inputs'].items():
+        for stage, result in stages.items():
+            old = baseline['inputs'].get(name, {}).get(stage)
+            if old is None:
+                continue
+            ratio = result['seconds'] / old['seconds']
+            flag = 'REGRESSION' if ratio > 1 + threshold else ''
+            print(f'{name:32} {stage:22} {old["seconds"] * 1000:10.2f} ms {result["seconds"] * 1000:10.2f} ms '
+                  f'{ratio:6.2f}x {flag}')
+            if flag:
+                regressions.append((name, stage, ratio))
+    return regressions
+
+def printReport(report: dict):
+    for name, stages in report['inputs'].items():
+        for stage, result in stages.items():
+            print(f'{name:32} {stage:22} {result["seconds"] * 1000:10.2f} ms {result["rate"]:12.2f} {result["unit"]}')
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                         '..', 'assets', 'cat.jpg'),
+                        help='real input, also tiled into the synthetic inputs')
+    parser.add_argument('--tiles', type=int, nargs='*', default=[2, 4],
+                        help='synthetic inputs tile the source N x N')
+    parser.add_argument('--restart-intervals', type=int, nargs='*', default=[0, 16], dest='restartIntervals',
+                        help='restart interval of each synthetic input, 0 for none')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per stage, the median is kept')
+    parser.add_argument('--symbols', type=int, default=100000,
+                        help='symbols in the getNextSymbol stream')
+    parser.add_argument('-o', '--output', help='write the results as JSON')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='compare against a saved JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='slowdown flagged as a regression in --compare')
+    args = parser.parse_args()
+
+    report = runBenchmarks(args.source, args.tiles, args.restartIntervals, args.repeat, args.symbols)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.close()
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+            f.close()
+        regressions = compareReports(baseline, report, args.threshold)
+        print(f'{len(regressions)} regression(s) beyond {args.threshold:.0%}')
+        exit(1 if regressions else 0)
+
+    printReport(report)
@@ -1,63 +1,270 @@
-from collections import deque
-from jpg import JPG
+import mmap
+import re
+
+# 0xFF followed by a stuffed zero or a RSTn marker inside entropy-coded data
+STUFFING = re.compile(rb'\xff+([\x00\xd0-\xd7])')
+# First marker that terminates an entropy-coded segment
+TERMINATOR = re.compile(rb'\xff+[^\x00\xd0-\xd7\xff]')
+# RSTn marker, including any fill bytes before it
+RESTART = re.compile(rb'\xff+[\xd0-\xd7]')
 
 class Bitreader:
+
+    # Raw bytes unstuffed per refill of the bit buffer
+    CHUNK = 1 << 16
+    # Bytes shifted into the accumulator at once
+    WORD = 8
+
     def __init__(self, fpath) -> None:
+        # The file is mapped, not read: opening is O(1) and only the pages
+        # the decoder touches become resident
         with open(fpath, 'rb') as f:
-            bytes = f.read()
-            self.bq = deque()
-            self.bq.extend(bytes)
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped
+                self.data = b''
             f.close()
 
-            self.nextBit = 0
-            self.nextByte = 0
+        self.pos = 0
+        self.resetBits()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # Safe to call more than once. A segment view still alive (e.g. held
+        # by the traceback of a failed decode) keeps the mapping open, it is
+        # then unmapped when the last view goes away
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:
+                pass
+        self.data = b''
+
+    @classmethod
+    def fromBytes(cls, data):
+        br = cls.__new__(cls)
+        br.data = data
+        br.pos = 0
+        br.resetBits()
+        return br
+
+    def resetBits(self):
+        self.bitMode = False
+        self.acc = 0
+        self.nbits = 0
+        self.padBits = 0
+        self.chunkStart = 0
+        self.chunkRaw = b''
+        self.buf = b''
+        self.bpos = 0
+        self.ended = False
 
     def hasBits(self):
-        return not (not self.bq)
-    
+        if self.bitMode:
+            return self.nbits > self.padBits or self.bpos < len(self.buf) or not self.ended
+        return self.pos < len(self.data)
+
     def readByte(self):
+        if self.bitMode:
+            self.leaveBitMode()
         assert self.hasBits()
-        b = self.bq.popleft()
+        b = self.data[self.pos]
+        self.pos += 1
         #print(f'Bitreader.readByte: {hex(b)}')
         return b
-    
+
     def peekByte(self):
+        if self.bitMode:
+            self.leaveBitMode()
         assert self.hasBits()
-        return self.bq[0]
+        return self.data[self.pos]
 
     def readWord(self):
         return (self.readByte() << 8) | self.readByte()
-    
-    def readBit(self):
-        if (self.nextBit == 0):
-            self.nextByte = self.readByte()
-            while self.nextByte == 0xff:
 
-                marker = self.peekByte()
-                while marker == 0xff:
-                    marker = self.readByte()
+    def readSegment(self, n):
+        # Zero-copy view of the next n bytes
+        if self.bitMode:
+            self.leaveBitMode()
+        assert self.pos + n <= len(self.data), 'Error - Unexpected end of file'
+        view = memoryview(self.data)[self.pos:self.pos + n]
+        self.pos += n
+        return view
+
+    def tell(self):
+        if self.bitMode:
+            self.leaveBitMode()
+        return self.pos
+
+    def seek(self, pos):
+        self.resetBits()
+        self.pos = pos
+
+    def scanRestartMarkers(self):
+        # Raw (start, end) of every restart interval in the entropy-coded
+        # segment at the current position, and the end of the segment
+        start = self.tell()
+        m = TERMINATOR.search(self.data, start)
+        end = m.start() if m is not None else len(self.data)
+
+        intervals = []
+        for m in RESTART.finditer(self.data, start, end):
+            intervals.append((start, m.start()))
+            start = m.end()
+        intervals.append((start, end))
+
+        return intervals, end
+
+    def skipSegment(self):
+        # Jump past the rest of the entropy-coded segment
+        m = TERMINATOR.search(self.data, self.tell())
+        self.seek(m.start() if m is not None else len(self.data))
+
+    def enterBitMode(self):
+        self.bitMode = True
+        self.chunkStart = self.pos
+        self.loadChunk()
+
+    def leaveBitMode(self):
+        # Drop the partially consumed byte and give back whole bytes still
+        # held in the accumulator, so byte reads resume right after the
+        # last byte touched by the entropy decoder
+        wholeBytes = max(0, self.nbits - self.padBits) // 8
+        self.pos = self.chunkStart + self.rawOffset(self.bpos - wholeBytes)
+        self.resetBits()
+
+    def rawOffset(self, u):
+        # Map an offset into the unstuffed chunk back to the raw chunk
+        removed = 0
+        for m in STUFFING.finditer(self.chunkRaw):
+            if m.start() - removed >= u:
+                break
+            removed += len(m.group()) - (1 if m.group(1) == b'\x00' else 0)
+        return u + removed
+
+    def loadChunk(self):
+        if self.chunkRaw:
+            # Restart the chunk at the first byte not yet shifted out, the
+            # partial byte left in the accumulator stays where it is
+            wholeBytes = self.nbits // 8
+            if wholeBytes == 0:
+                self.chunkStart += len(self.chunkRaw)
+            else:
+                self.chunkStart += self.rawOffset(self.bpos - wholeBytes)
+            self.acc >>= 8 * wholeBytes
+            self.nbits -= 8 * wholeBytes
 
-                if marker == 0x00:
-                    self.readByte()
-                    break
+        start = self.chunkStart
+        end = min(start + self.CHUNK, len(self.data))
+        while end < len(self.data) and self.data[end - 1] == 0xff:
+            end += 1
 
-                assert marker >= JPG.RST0 and marker <= JPG.RST7, f'Error - Invalid marker: {marker}'
+        m = TERMINATOR.search(self.data, start, end)
+        if m is not None:
+            end = m.start()
+            self.ended = True
+        elif end == len(self.data):
+            self.ended = True
 
-                self.readByte()
-                self.nextByte = self.readByte()
+        self.chunkRaw = self.data[start:end]
+        self.buf = STUFFING.sub(lambda m: b'\xff' if m.group(1) == b'\x00' else b'', self.chunkRaw)
+        self.bpos = 0
 
+    def refill(self):
+        while self.bpos >= len(self.buf) and not self.ended:
+            self.loadChunk()
 
-        bit = (self.nextByte >> (7 - self.nextBit)) & 1
-        self.nextBit = (self.nextBit + 1) % 8
+        word = self.buf[self.bpos:self.bpos + self.WORD]
+        if word:
+            self.bpos += len(word)
+            self.acc = (self.acc << (8 * len(word))) | int.from_bytes(word, 'big')
+            self.nbits += 8 * len(word)
+        else:
+            # Past the end of the segment: feed zero bits
+            self.acc <<= 8 * self.WORD
+            self.nbits += 8 * self.WORD
+            self.padBits += 8 * self.WORD
+
+    def peekBits(self, n):
+        if not self.bitMode:
+            self.enterBitMode()
+        while self.nbits < n:
+            self.refill()
+        return self.acc >> (self.nbits - n)
+
+    def skipBits(self, n):
+        if not self.bitMode:
+            self.enterBitMode()
+        while self.nbits < n:
+            self.refill()
+        self.nbits -= n
+        self.acc &= (1 << self.nbits) - 1
+        assert self.nbits >= self.padBits, 'Error - Read past end of entropy-coded data'
 
-        return bit
-    
     def readBits(self, n):
-        bits = 0
-        for _ in range(n):
-            bit = self.readBit()
-            bits = (bits << 1) | bit
+        n = int(n)
+        if not self.bitMode:
+            self.enterBitMode()
+        while self.nbits < n:
+            self.refill()
+        self.nbits -= n
+        bits = self.acc >> self.nbits
+        self.acc &= (1 << self.nbits) - 1
+        assert self.nbits >= self.padBits, 'Error - Read past end of entropy-coded data'
         return bits
 
+    def readBit(self):
+        return self.readBits(1)
+
     def align(self):
-        self.nextBit = 0
\ No newline at end of file
+        if self.bitMode:
+            self.nbits -= self.nbits % 8
+            self.acc &= (1 << self.nbits) - 1
+
+class StreamReader:
+    # Byte API of Bitreader over small buffered reads, for walking the
+    # header segments without loading the file
+
+    BUFFER = 4096
+
+    def __init__(self, fpath) -> None:
+        self.f = open(fpath, 'rb', buffering=self.BUFFER)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def readByte(self):
+        b = self.f.read(1)
+        assert b, 'Error - Unexpected end of file'
+        return b[0]
+
+    def peekByte(self):
+        b = self.f.peek(1)[:1]
+        assert b, 'Error - Unexpected end of file'
+        return b[0]
+
+    def readWord(self):
+        return (self.readByte() << 8) | self.readByte()
+
+    def readSegment(self, n):
+        b = self.f.read(n)
+        assert len(b) == n, 'Error - Unexpected end of file'
+        return memoryview(b)
+
+    def tell(self):
+        return self.f.tell()
+
+    def seek(self, pos):
+        self.f.seek(pos)
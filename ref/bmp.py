@@ -1,4 +1,5 @@
 
+import numpy as np
 from jpg import *
 
 class Bmp:
@@ -13,10 +14,19 @@ class Bmp:
         buffer.append((v >> 24) & 0xff)
 
     def writeBMP(self, image: JPGImage, fpath):
+        buffer = self.toBytes(image)
+
+        with open(fpath, 'wb') as f:
+            f.write(buffer)
+            f.close()
+
+    def toBytes(self, image: JPGImage):
+        # The RGB image may be smaller than the frame when decoded at a scale
+        height, width = image.rgb.shape[:2]
 
         buffer = bytearray()
-        paddingSize = image.width % 4
-        size = 14 + 12 + image.height * image.width * 3 + paddingSize * image.height
+        paddingSize = width % 4
+        size = 14 + 12 + height * width * 3 + paddingSize * height
 
         buffer.extend('B'.encode('utf-8'))
         buffer.extend('M'.encode('utf-8'))
@@ -25,32 +35,95 @@ class Bmp:
         self.putInt(buffer, 0)
         self.putInt(buffer, 0x1A)
         self.putInt(buffer, 12)
-        self.putShort(buffer, image.width)
-        self.putShort(buffer, image.height)
+        self.putShort(buffer, width)
+        self.putShort(buffer, height)
         self.putShort(buffer, 1)
         self.putShort(buffer, 24)
 
-        for y in range(image.height-1, -1, -1):
-            blockRow = y // 8
-            pixelRow = y % 8
-            for x in range(image.width):
-                blockColumn = x // 8
-                pixelColumn = x % 8
-                blockIndex = int(blockRow * image.blockWidthReal + blockColumn)
-                pixelIndex = int(pixelRow * 8 + pixelColumn)
+        # Bottom-up BGR rows, each padded to a multiple of 4 bytes
+        pixels = np.zeros((height, width * 3 + paddingSize), dtype=np.uint8)
+        pixels[:, :width * 3] = image.rgb[::-1, :, ::-1].reshape(height, -1)
+        buffer.extend(pixels.tobytes())
+        return buffer
+
+    def putInfoHeader(self, buffer: bytearray, width, height):
+        # File header and 40-byte BITMAPINFOHEADER of a top-down image
+        paddingSize = width % 4
+        imageSize = height * (width * 3 + paddingSize)
+
+        buffer.extend('B'.encode('utf-8'))
+        buffer.extend('M'.encode('utf-8'))
+
+        self.putInt(buffer, 14 + 40 + imageSize)
+        self.putInt(buffer, 0)
+        self.putInt(buffer, 14 + 40)
+        self.putInt(buffer, 40)
+        self.putInt(buffer, width)
+        self.putInt(buffer, -height)
+        self.putShort(buffer, 1)
+        self.putShort(buffer, 24)
+        self.putInt(buffer, 0)
+        self.putInt(buffer, imageSize)
+        self.putInt(buffer, 2835)
+        self.putInt(buffer, 2835)
+        self.putInt(buffer, 0)
+        self.putInt(buffer, 0)
 
-                b = int(image.blocks[blockIndex].cr_b[pixelIndex])
-                g = int(image.blocks[blockIndex].cb_g[pixelIndex])
-                r = int(image.blocks[blockIndex].y_r[pixelIndex])
+    def writeBMPRows(self, rows, fpath):
+        # Streams (bandHeight, width, 3) RGB bands into a top-down BMP, the
+        # header is written again with the final size once every band is in
+        width = 0
+        height = 0
 
-                buffer.append(b)
-                buffer.append(g)
-                buffer.append(r)
+        with open(fpath, 'wb') as f:
+            header = bytearray()
+            self.putInfoHeader(header, 0, 0)
+            f.write(header)
 
-                for i in range(paddingSize):
-                    buffer.append(0)
+            for band in rows:
+                bandHeight, width = band.shape[:2]
+                paddingSize = width % 4
+                pixels = np.zeros((bandHeight, width * 3 + paddingSize), dtype=np.uint8)
+                pixels[:, :width * 3] = band[:, :, ::-1].reshape(bandHeight, -1)
+                f.write(pixels.tobytes())
+                height += bandHeight
 
+            header = bytearray()
+            self.putInfoHeader(header, width, height)
+            f.seek(0)
+            f.write(header)
 
+    def writeRawRows(self, rows, fpath):
+        # Headerless interleaved RGB, one band at a time
         with open(fpath, 'wb') as f:
-            f.write(buffer)
-            f.close()
\ No newline at end of file
+            for band in rows:
+                f.write(band.tobytes())
+
+    def readBMP(self, fpath):
+        # Uncompressed 24-bit BMP with either header, bottom-up or top-down;
+        # returns (height, width, 3) RGB
+        with open(fpath, 'rb') as f:
+            data = f.read()
+            f.close()
+
+        assert data[:2] == b'BM', f'Error - Not a BMP file: {fpath}'
+        offset = int.from_bytes(data[10:14], 'little')
+        headerSize = int.from_bytes(data[14:18], 'little')
+
+        if headerSize == 12:
+            width = int.from_bytes(data[18:20], 'little')
+            height = int.from_bytes(data[20:22], 'little', signed=True)
+            bitCount = int.from_bytes(data[24:26], 'little')
+            compression = 0
+        else:
+            width = int.from_bytes(data[18:22], 'little', signed=True)
+            height = int.from_bytes(data[22:26], 'little', signed=True)
+            bitCount = int.from_bytes(data[28:30], 'little')
+            compression = int.from_bytes(data[30:34], 'little')
+
+        assert bitCount == 24 and compression == 0, 'Error - Only uncompressed 24-bit BMPs supported'
+
+        rowSize = width * 3 + width % 4
+        pixels = np.frombuffer(data, dtype=np.uint8, count=abs(height) * rowSize, offset=offset)
+        rgb = pixels.reshape(abs(height), rowSize)[:, :width * 3].reshape(abs(height), width, 3)[:, :, ::-1]
+        return rgb[::-1] if height > 0 else rgb
@@ -1,55 +1,130 @@
 
+import math
+import numpy as np
 from jpg import *
 
+def blocksToPixels(plane: np.ndarray, height: int, width: int):
+    # (blockRows, blockCols, n * n) plane -> (height, width) pixel view/copy,
+    # n is 8 unless the image is decoded at a reduced scale
+    blockRows, blockCols, blockSamples = plane.shape
+    n = math.isqrt(blockSamples)
+    pixels = plane.reshape(blockRows, blockCols, n, n).transpose(0, 2, 1, 3)
+    return pixels.reshape(blockRows * n, blockCols * n)[:height, :width]
+
 class CSpace:
 
-    def __init__(self) -> None:
-        pass
+    # Conversion constants as 16-bit fixed-point integers, samples keep
+    # SAMPLE_BITS fractional bits in the integer path
+    COEFF_BITS = 16
+    SAMPLE_BITS = 8
+    CR_R = round(1.402 * (1 << COEFF_BITS))
+    CB_G = round(0.344 * (1 << COEFF_BITS))
+    CR_G = round(0.714 * (1 << COEFF_BITS))
+    CB_B = round(1.772 * (1 << COEFF_BITS))
+
+    def __init__(self, backend: str = 'numpy') -> None:
+        assert backend in ['numpy', 'fixed', 'scalar'], f'Error - Unknown color conversion backend: {backend}'
+        self.backend = backend
 
     def YCbCrToRGBBlock(self, yBlock: Block, cbcrBlock: Block, vSamp, hSamp, v, h):
+        # Fetch the plane views once, each property access builds a new view
+        y_r, cb_g, cr_b = yBlock.y_r, yBlock.cb_g, yBlock.cr_b
+        cb, cr = cbcrBlock.cb_g, cbcrBlock.cr_b
         for y in range(7, -1, -1):
             for x in range(7, -1, -1):
                 pixel = y * 8 + x
                 cbcrPixelRow = y // vSamp + 4 * v
                 cbcrPixelColumn = x // hSamp + 4 * h
                 cbcrPixel = cbcrPixelRow * 8 + cbcrPixelColumn
-                r = yBlock.y_r[pixel]                                    + 1.402 * cbcrBlock.cr_b[cbcrPixel] + 128
-                g = yBlock.y_r[pixel] - 0.344 * cbcrBlock.cb_g[cbcrPixel] - 0.714 * cbcrBlock.cr_b[cbcrPixel] + 128
-                b = yBlock.y_r[pixel] + 1.772 * cbcrBlock.cb_g[cbcrPixel]                                    + 128
+                r = y_r[pixel]                          + 1.402 * cr[cbcrPixel] + 128
+                g = y_r[pixel] - 0.344 * cb[cbcrPixel] - 0.714 * cr[cbcrPixel] + 128
+                b = y_r[pixel] + 1.772 * cb[cbcrPixel]                          + 128
                 if (r < 0):   r = 0
                 if (r > 255): r = 255
                 if (g < 0):   g = 0
                 if (g > 255): g = 255
                 if (b < 0):   b = 0
                 if (b > 255): b = 255
-                yBlock.y_r[pixel] = r
-                yBlock.cb_g[pixel] = g
-                yBlock.cr_b[pixel] = b
+                y_r[pixel] = r
+                cb_g[pixel] = g
+                cr_b[pixel] = b
 
-    def YCbCrToRGB(self, image: JPGImage):
+    def componentPixels(self, image: JPGImage, i: int, height: int, width: int):
+        # Full-resolution (height, width) view of a component, subsampled
+        # components are replicated in a single gather
+        component: ColorComponent = image.colorComponents[i]
         vSamp = image.verticalSamplingFactor
         hSamp = image.horizontalSamplingFactor
 
-        if vSamp != 1 or hSamp != 1:
-            assert False, 'Not supported'
-            self.YCbCrToRGBSample(image)
+        if i >= image.numComponents or \
+                (component.verticalSamplingFactor == vSamp and component.horizontalSamplingFactor == hSamp):
+            return blocksToPixels(component.samples, height, width)
+
+        n = image.blockSize
+        pixels = blocksToPixels(component.samples, component.blockHeight * n, component.blockWidth * n)
+        rows = np.arange(height) * component.verticalSamplingFactor // vSamp
+        columns = np.arange(width) * component.horizontalSamplingFactor // hSamp
+        return pixels[rows[:, None], columns[None, :]]
+
+    def YCbCrToRGBImage(self, image: JPGImage, height: int, width: int):
+        y = self.componentPixels(image, 0, height, width)
+        cb = self.componentPixels(image, 1, height, width)
+        cr = self.componentPixels(image, 2, height, width)
+
+        image.rgb = np.empty((height, width, 3), dtype=np.uint8)
+
+        if self.backend == 'fixed':
+            one = 1 << self.SAMPLE_BITS
+            y = np.floor(y * one).astype(np.int64) << self.COEFF_BITS
+            cb = np.floor(cb * one).astype(np.int64)
+            cr = np.floor(cr * one).astype(np.int64)
+            offset = 128 << (self.SAMPLE_BITS + self.COEFF_BITS)
+            shift = self.SAMPLE_BITS + self.COEFF_BITS
+
+            r = (y                  + self.CR_R * cr + offset) >> shift
+            g = (y - self.CB_G * cb - self.CR_G * cr + offset) >> shift
+            b = (y + self.CB_B * cb                  + offset) >> shift
         else:
-            self.YCbCrToRGBNoSample(image)
+            # Same operation order as YCbCrToRGBBlock
+            r = y              + 1.402 * cr + 128
+            g = y - 0.344 * cb - 0.714 * cr + 128
+            b = y + 1.772 * cb              + 128
+
+        image.rgb[:, :, 0] = np.clip(r, 0, 255)
+        image.rgb[:, :, 1] = np.clip(g, 0, 255)
+        image.rgb[:, :, 2] = np.clip(b, 0, 255)
+
+    def RGBToYCbCr(self, rgb: np.ndarray):
+        # (height, width, 3) RGB -> Y, Cb, Cr planes, all centered on zero
+        # for the forward DCT
+        r, g, b = [rgb[:, :, i].astype(np.float64) for i in range(3)]
+        y = 0.299 * r + 0.587 * g + 0.114 * b - 128
+        cb = -0.168736 * r - 0.331264 * g + 0.5 * b
+        cr = 0.5 * r - 0.418688 * g - 0.081312 * b
+        return [y, cb, cr]
+
+    def YCbCrToRGB(self, image: JPGImage, height: int = None, width: int = None):
+        # height and width crop the planes to the pixels they hold, less than
+        # the image size when they contain a single band or a region
+        if height is None:
+            height = image.outputHeight
+        if width is None:
+            width = image.outputWidth
 
-    def YCbCrToRGBSample(self, image: JPGImage):
         vSamp = image.verticalSamplingFactor
         hSamp = image.horizontalSamplingFactor
 
-        for y in range(0, image.blockHeight, vSamp):
-            for x in range(0, image.blockWidth, hSamp):
-                cbcrBlock: Block = image.blocks[y * image.blockWidthReal + x]
-                for v in range(vSamp-1, -1, -1):
-                    for h in range(hSamp-1, -1, -1):
-                        print(f'{v=} {h=}')
-                        yBlock: Block = image.blocks[y * image.blockWidthReal + x]
-                        self.YCbCrToRGBBlock(yBlock, cbcrBlock, vSamp, hSamp, v, h)
-
+        if self.backend == 'scalar':
+            assert vSamp == 1 and hSamp == 1, 'Error - Per-pixel color conversion needs 1x1 sampling'
+            assert image.scale == 1, 'Error - Per-pixel color conversion needs full-scale blocks'
+            self.YCbCrToRGBNoSample(image, height, width)
+        else:
+            self.YCbCrToRGBImage(image, height, width)
 
-    def YCbCrToRGBNoSample(self, image: JPGImage):
+    def YCbCrToRGBNoSample(self, image: JPGImage, height: int, width: int):
         for block in image.blocks:
-            self.YCbCrToRGBBlock(block, block, 1, 1, 0, 0)
\ No newline at end of file
+            self.YCbCrToRGBBlock(block, block, 1, 1, 0, 0)
+
+        # The per-block path converts the sample planes in place
+        image.rgb = np.stack([blocksToPixels(image.colorComponents[i].samples, height, width)
+                              for i in range(3)], axis=2).astype(np.uint8)
\ No newline at end of file
@@ -1,11 +1,25 @@
 
 
 import math
+import numpy as np
 
 from jpg import *
 
+def kernelSizes():
+    # Smallest square IDCT support (1, 2, 4 or 8) covering every coefficient
+    # up to a given zigzag index
+    sizes = []
+    support = 0
+    for z in zigZagMap:
+        support = max(support, z // 8 + 1, z % 8 + 1)
+        sizes.append(1 if support == 1 else 2 if support == 2 else 4 if support <= 4 else 8)
+    return np.array(sizes, dtype=np.int8)
+
 class Dct:
 
+    KERNELS = [(1, 'dc'), (2, '2x2'), (4, '4x4'), (8, 'full')]
+    kernelSizeForEob = kernelSizes()
+
     m0 = 2.0 * math.cos(1.0 / 16.0 * 2.0 * math.pi)
     m1 = 2.0 * math.cos(2.0 / 16.0 * 2.0 * math.pi)
     m3 = 2.0 * math.cos(2.0 / 16.0 * 2.0 * math.pi)
@@ -22,8 +36,89 @@ class Dct:
     s6 = math.cos(6.0 / 16.0 * math.pi) / 2.0
     s7 = math.cos(7.0 / 16.0 * math.pi) / 2.0
 
-    def __init__(self) -> None:
-        pass
+    def __init__(self, backend: str = 'numpy', fractionBits: int = None) -> None:
+        assert backend in ['numpy', 'scalar'], f'Error - Unknown IDCT backend: {backend}'
+        self.backend = backend
+        self.fractionBits = fractionBits
+        self.kernelCounts = { name: 0 for _, name in self.KERNELS }
+        self.scaledCount = 0
+
+    def inverseDCT1D(self, v0, v1, v2, v3, v4, v5, v6, v7):
+        # AAN butterfly on natural-order inputs, works on scalars and on
+        # arrays alike with the same operation order as the scalar path
+        g0 = v0 * self.s0
+        g1 = v4 * self.s4
+        g2 = v2 * self.s2
+        g3 = v6 * self.s6
+        g4 = v5 * self.s5
+        g5 = v1 * self.s1
+        g6 = v7 * self.s7
+        g7 = v3 * self.s3
+
+        f4 = g4 - g7
+        f5 = g5 + g6
+        f6 = g5 - g6
+        f7 = g4 + g7
+
+        e2 = g2 - g3
+        e3 = g2 + g3
+        e5 = f5 - f7
+        e7 = f5 + f7
+        e8 = f4 + f6
+
+        d2 = e2 * self.m1
+        d4 = f4 * self.m2
+        d5 = e5 * self.m3
+        d6 = f6 * self.m4
+        d8 = e8 * self.m5
+
+        c0 = g0 + g1
+        c1 = g0 - g1
+        c2 = d2 - e3
+        c4 = d4 + d8
+        c5 = d5 + e7
+        c6 = d6 - d8
+        c8 = c5 - c6
+
+        b0 = c0 + e3
+        b1 = c1 + c2
+        b2 = c1 - c2
+        b3 = c0 - e3
+        b4 = c4 - c8
+        b6 = c6 - e7
+
+        return (b0 + e7, b1 + b6, b2 + c8, b3 + b4,
+                b3 - b4, b2 - c8, b1 - b6, b0 - e7)
+
+    def inverseDCTKernel(self, b: np.ndarray, k: int, transform1D):
+        # b: (M, 8, 8) blocks whose coefficients outside the top-left k x k
+        # are all zero; those inputs are passed as constants, so the butterfly
+        # only touches k columns in the first pass and k inputs in the second
+        columns = transform1D(*(b[:, r, :k] if r < k else 0 for r in range(8)))
+        intermediate = np.stack(columns, axis=1)
+
+        rows = transform1D(*(intermediate[:, :, c] if c < k else 0 for c in range(8)))
+        return np.stack(rows, axis=2)
+
+    def inverseDCTSparse(self, b: np.ndarray, eobs: np.ndarray, transform1D):
+        if eobs is None:
+            sizes = np.full(len(b), 8, dtype=np.int8)
+        else:
+            sizes = self.kernelSizeForEob[eobs]
+
+        out = np.empty_like(b)
+        for k, name in self.KERNELS:
+            selected = np.flatnonzero(sizes == k)
+            if len(selected):
+                out[selected] = self.inverseDCTKernel(b[selected], k, transform1D)
+                self.kernelCounts[name] += len(selected)
+        return out
+
+    def inverseDCTBatch(self, blocks: np.ndarray, eobs: np.ndarray = None):
+        # blocks: (N, 64) natural-order coefficients, transformed in place
+        b = blocks.reshape(-1, 8, 8)
+        b[:] = self.inverseDCTSparse(b, eobs, self.inverseDCT1D)
+        b += 0.5
 
     def inverseDCTBlockComponent(self, component: list):
 
@@ -163,29 +258,124 @@ class Dct:
             component[i * 8 + 6] = b1 - b6 + 0.5
             component[i * 8 + 7] = b0 - b7 + 0.5
 
+    def inverseDCT1DFixed(self, v0, v1, v2, v3, v4, v5, v6, v7):
+        # Integer AAN butterfly, inputs already carry the prescale factors and
+        # fractionBits fractional bits; products are rounded half up
+        F = self.fractionBits
+        half = 1 << (F - 1)
+        m1 = round(self.m1 * (1 << F))
+        m2 = round(self.m2 * (1 << F))
+        m3 = round(self.m3 * (1 << F))
+        m4 = round(self.m4 * (1 << F))
+        m5 = round(self.m5 * (1 << F))
+
+        f4 = v5 - v3
+        f5 = v1 + v7
+        f6 = v1 - v7
+        f7 = v5 + v3
+
+        e2 = v2 - v6
+        e3 = v2 + v6
+        e5 = f5 - f7
+        e7 = f5 + f7
+        e8 = f4 + f6
+
+        d2 = (e2 * m1 + half) >> F
+        d4 = (f4 * m2 + half) >> F
+        d5 = (e5 * m3 + half) >> F
+        d6 = (f6 * m4 + half) >> F
+        d8 = (e8 * m5 + half) >> F
+
+        c0 = v0 + v4
+        c1 = v0 - v4
+        c2 = d2 - e3
+        c4 = d4 + d8
+        c5 = d5 + e7
+        c6 = d6 - d8
+        c8 = c5 - c6
+
+        b0 = c0 + e3
+        b1 = c1 + c2
+        b2 = c1 - c2
+        b3 = c0 - e3
+        b4 = c4 - c8
+        b6 = c6 - e7
+
+        return (b0 + e7, b1 + b6, b2 + c8, b3 + b4,
+                b3 - b4, b2 - c8, b1 - b6, b0 - e7)
+
+    def inverseDCTFixedBatch(self, coeffs: np.ndarray, prescaled: np.ndarray, eobs: np.ndarray = None):
+        # coeffs: (N, 64) quantized coefficients, returns (N, 64) int64 samples
+        b = (coeffs.astype(np.int64) * prescaled).reshape(-1, 8, 8)
+        samples = self.inverseDCTSparse(b, eobs, self.inverseDCT1DFixed)
+        return ((samples + (1 << (self.fractionBits - 1))) >> self.fractionBits).reshape(-1, 64)
+
+    def inverseDCTFixed(self, image: JPGImage, quantizationTables: list):
+        # Dequantization is folded into the prescaled tables, so this runs
+        # directly on the Huffman decoder output. quantizationTables: one
+        # QuantizationTable per component
+        for i in range(image.numComponents):
+            component: ColorComponent = image.colorComponents[i]
+            prescaled = quantizationTables[i].prescaled
+            samples = self.inverseDCTFixedBatch(component.coeffs.reshape(-1, 64), prescaled,
+                                                component.eobs.reshape(-1))
+            component.samples.reshape(-1, 64)[:] = samples
+
+    def scaledMatrix(self, k: int):
+        # k-point IDCT basis with the 8-point normalization: applied to the
+        # top-left k x k coefficients it gives the mean of the (8 / k)^2
+        # pixels each output sample stands for
+        m = np.arange(k)[:, None]
+        u = np.arange(k)[None, :]
+        M = np.cos((2 * m + 1) * u * math.pi / (2 * k)) / 2.0
+        M[:, 0] = 1.0 / math.sqrt(8)
+        return M
+
+    def forwardDCTBatch(self, blocks: np.ndarray):
+        # (N, 8, 8) level-shifted samples -> (N, 64) natural-order
+        # coefficients, the transpose of the 8-point IDCT basis
+        M = self.scaledMatrix(8)
+        return (M.T @ blocks @ M).reshape(-1, 64)
+
+    def inverseDCTScaled(self, image: JPGImage, quantizationTables: list):
+        # Reduced k x k IDCT of the low-frequency coefficients, dequantization
+        # included, for decoding at 1/2, 1/4 or 1/8 scale (k = 4, 2 or 1).
+        # quantizationTables: one QuantizationTable per component
+        k = image.blockSize
+        M = self.scaledMatrix(k)
+
+        for i in range(image.numComponents):
+            component: ColorComponent = image.colorComponents[i]
+            table = quantizationTables[i].table.reshape(8, 8)[:k, :k]
+            coeffs = component.coeffs.reshape(-1, 8, 8)[:, :k, :k]
+
+            if self.fractionBits is None:
+                samples = M @ (coeffs * table) @ M.T + 0.5
+            else:
+                F = self.fractionBits
+                MF = np.round(M * (1 << F)).astype(np.int64)
+                b = coeffs.astype(np.int64) * table.astype(np.int64)
+                samples = (MF @ b @ MF.T + (1 << (2 * F - 1))) >> (2 * F)
+
+            component.samples.reshape(-1, k * k)[:] = samples.reshape(-1, k * k)
+            self.scaledCount += len(samples)
+
     def inverseDCT(self, image: JPGImage):
-        vSamp = image.verticalSamplingFactor
-        hSamp = image.horizontalSamplingFactor
+        # Chroma planes of subsampled images are transformed at their native
+        # resolution, upsampling happens in the color conversion
+        for i in range(image.numComponents):
+            component: ColorComponent = image.colorComponents[i]
+            samples = component.samples.reshape(-1, 64)
 
-        if vSamp != 1 or hSamp != 1:
-            assert False, 'Not supported'
-            self.inverseDCTSample(image)
-        else:
-            self.inverseDCTNoSample(image)
-
-    def inverseDCTSample(self, image: JPGImage):
-        for y in range(0, image.blockHeight, image.verticalSamplingFactor):
-            for x in range(0, image.blockWidth, image.horizontalSamplingFactor):
-                for i in range(image.numComponents):
-                    component: ColorComponent = image.colorComponents[i]
-                    for v in range(component.verticalSamplingFactor):
-                        for h in range(component.horizontalSamplingFactor):
-                            block = image.blocks[(y + v) * image.blockWidthReal + (x + h)][i]
-                            self.inverseDCTBlockComponent(block)
-                            image.blocks[(y + v) * image.blockWidthReal + (x + h)][i] = block
-
-
-    def inverseDCTNoSample(self, image: JPGImage):
-        for block in image.blocks:
-            for i in range(image.numComponents):
-                self.inverseDCTBlockComponent(block[i])
\ No newline at end of file
+            if self.backend == 'numpy':
+                self.inverseDCTBatch(samples, component.eobs.reshape(-1))
+            else:
+                for block in samples:
+                    self.inverseDCTBlockComponent(block)
+
+    def printKernelInfo(self):
+        print("IDCT kernels=============")
+        for _, name in self.KERNELS:
+            print(f"{name}: {self.kernelCounts[name]} blocks")
+        if self.scaledCount:
+            print(f"scaled: {self.scaledCount} blocks")
@@ -6,6 +6,9 @@ from quant import *
 from dct import *
 from cspace import *
 from bmp import *
+from rstindex import *
+from stats import *
+from contextlib import nullcontext
 
 class Decoder:
 
@@ -15,17 +18,34 @@ class Decoder:
     quant: Quantization
     dct: Dct
     cspace: CSpace
-
-    def __init__(self, br: Bitreader) -> None:
+    index: RestartIndex = None
+    # Huffman tables are seeked over when only the header is wanted
+    headerOnly: bool = False
+    # Silent unless an Instrumentation is attached
+    instrument: Instrumentation = None
+    # preview(scanCount, rgb) is called with a rendering of the coefficients
+    # decoded so far after every scan of a progressive frame
+    preview = None
+
+    def __init__(self, br: Bitreader, workers: int = 1, idct: str = 'numpy',
+                 fractionBits: int = None, cspace: str = 'numpy', scale: int = 1,
+                 instrument: Instrumentation = None) -> None:
+        assert scale in [1, 2, 4, 8], f'Error - Unsupported scale: 1/{scale}'
+        assert fractionBits is None or 1 <= fractionBits <= 16, \
+            f'Error - Fixed-point fraction bits must be 1 to 16: {fractionBits}'
         self.br = br
+        self.workers = workers
+        self.fractionBits = fractionBits
+        self.instrument = instrument
         self.image = JPGImage()
-        self.huff = HuffmanDecoder(br)
-        self.quant = Quantization(br)
-        self.dct = Dct()
-        self.cspace = CSpace()
+        self.image.scale = scale
+        # Symbols are only counted for instrumented decodes
+        self.huff = (HuffmanDecoder if instrument is None else CountingHuffmanDecoder)(br, scale == 8)
+        self.quant = Quantization(br, fractionBits)
+        self.dct = Dct(idct, fractionBits)
+        self.cspace = CSpace(cspace)
 
     def readStartOfFrame(self):
-        print('Reading SOF Marker')
         assert self.image.numComponents == 0, 'Error - Multiple SOFs detected'
 
         length = self.br.readWord()
@@ -70,9 +90,9 @@ class Decoder:
             component.verticalSamplingFactor = samplingFactor & 0x0F
 
             if componentID == 1:
-                assert component.horizontalSamplingFactor == 1 and component.horizontalSamplingFactor != 2, \
+                assert component.horizontalSamplingFactor in [1, 2], \
                     'Error - Sampling factors not supported'
-                assert component.verticalSamplingFactor == 1 and component.verticalSamplingFactor != 2, \
+                assert component.verticalSamplingFactor in [1, 2], \
                     'Error - Sampling factors not supported'
 
                 if (component.horizontalSamplingFactor == 2 and self.image.blockWidth % 2 == 1):
@@ -93,29 +113,36 @@ class Decoder:
         assert length - 8 - (3 * self.image.numComponents) == 0, 'Error - SOF invalid'
 
     def readRestartInterval(self):
-        print('Reading DRI Marker')
 
         length = self.br.readWord()
         self.image.restartInterval = self.br.readWord()
         assert length - 4 == 0, 'Error - DRI invalid'
 
     def readAPPN(self):
-        print('Reading APPN Marker')
         length = self.br.readWord()
 
         assert length >= 2, 'Error - APPN invalid'
 
-        for _ in range(length-2):
-            self.br.readByte()
+        self.br.seek(self.br.tell() + length - 2)
 
     def readComment(self):
-        print('Reading COM Marker')
         length = self.br.readWord()
 
         assert length >= 2, 'Error - COM invalid'
 
-        for _ in range(length-2):
-            self.br.readByte()
+        self.br.seek(self.br.tell() + length - 2)
+
+    def stage(self, name: str):
+        if self.instrument is None:
+            return nullcontext()
+        return self.instrument.stage(name)
+
+    def skipSegment(self):
+        length = self.br.readWord()
+
+        assert length >= 2, 'Error - Segment invalid'
+
+        self.br.seek(self.br.tell() + length - 2)
 
     def readFrameHeader(self):
         last = self.br.readByte()
@@ -129,6 +156,9 @@ class Decoder:
         while self.image.valid:
             assert last == 0xff, 'Error - Expected a marker'
 
+            if self.instrument is not None and current != 0xff:
+                self.instrument.marker(current, self.br.tell() - 2)
+
             if current == JPG.SOF0:
                 self.image.frameType = JPG.SOF0
                 self.readStartOfFrame()
@@ -138,7 +168,10 @@ class Decoder:
             elif current == JPG.DQT:
                 self.quant.readQuantizationTable()
             elif current == JPG.DHT:
-                self.huff.readHuffmanTable()
+                if self.headerOnly:
+                    self.skipSegment()
+                else:
+                    self.huff.readHuffmanTable()
             elif current == JPG.SOS:
                 break
             elif current == JPG.DRI:
@@ -172,7 +205,6 @@ class Decoder:
             current = self.br.readByte()
 
     def readStartOfScan(self):
-        print('Reading SOS Marker')
 
         assert self.image.numComponents != 0
         length = self.br.readWord()
@@ -220,16 +252,35 @@ class Decoder:
             assert self.image.successiveApproximationHigh == 0 and self.image.successiveApproximationLow == 0, \
                 'Error - Invalid successive approximation'
         elif self.image.frameType == JPG.SOF2:
-            assert False, 'JPG.SOF2: Not supported'
+            if self.image.startOfSelection == 0:
+                assert self.image.endOfSelection == 0, 'Error - Invalid spectral selection'
+            else:
+                assert self.image.startOfSelection <= self.image.endOfSelection <= 63, \
+                    'Error - Invalid spectral selection'
+                assert self.image.componentsInScan == 1, 'Error - AC scan with more than one color component'
+
+            assert self.image.successiveApproximationHigh <= 13 and self.image.successiveApproximationLow <= 13, \
+                'Error - Invalid successive approximation'
+
+        # Progressive DC scans use no AC table and refinements no DC table
+        progressive = self.image.frameType == JPG.SOF2
+        needDC = not progressive or (self.image.startOfSelection == 0 and self.image.successiveApproximationHigh == 0)
+        needAC = not progressive or self.image.startOfSelection != 0
 
         for i in range(self.image.numComponents):
             component: ColorComponent = self.image.colorComponents[i]
 
             if component.usedInScan:
-                assert self.huff.dcTables[component.huffmanDCTableID].set, \
+                # The quantization table is fixed at the component's first scan
+                if component.qTable is None:
+                    qTable: QuantizationTable = self.quant.quantizationTables[component.quantizationTableID]
+                    assert qTable.set, 'Error - Color component using uninitialized quantization table'
+                    component.qTable = qTable
+
+                assert not needDC or self.huff.dcTables[component.huffmanDCTableID].set, \
                     'Error - Color component using uninitialized Huffman DC table'
 
-                assert self.huff.acTables[component.huffmanACTableID].set, \
+                assert not needAC or self.huff.acTables[component.huffmanACTableID].set, \
                     'Error - Color component using uninitialized Huffman AC table'
 
         assert length - 6 - (2 * self.image.componentsInScan) == 0, 'Error - SOS invalid'
@@ -253,12 +304,93 @@ class Decoder:
         print(f"Restart Interval: {self.image.restartInterval}")
 
     def readScans(self):
+        if self.image.frameType == JPG.SOF2:
+            assert self.image.region is None, 'Error - ROI decoding of progressive frames not supported'
+
+            self.readScan()
+            while self.readScanTables():
+                self.readScan()
+
+            self.image.computeEobs()
+            return
+
+        self.readScan()
+        self.readEndOfImage()
+
+    def readScan(self):
         self.readStartOfScan()
 
-        self.printScanInfo()
+        if self.instrument is not None:
+            self.instrument.scan(self)
+
+        scanStart = self.br.tell()
+        skippedBytes = self.huff.skippedBytes
+
+        with self.stage('huffman'):
+            if self.image.frameType == JPG.SOF2:
+                self.huff.decodeProgressiveScan(self.image)
+            else:
+                restarts = None
+                if self.index is not None:
+                    assert self.br.tell() == self.index.scanStart, 'Error - Restart index does not match the file'
+                    restarts = self.index.intervals()
+
+                if self.image.region is not None:
+                    self.huff.decodeHuffmanDataRegion(self.image, restarts)
+                elif self.workers > 1 and self.image.restartInterval != 0:
+                    self.huff.decodeHuffmanDataParallel(self.image, self.workers, restarts)
+                else:
+                    self.huff.decodeHuffmanData(self.image)
+
+        if self.instrument is not None:
+            self.instrument.stats.entropyBytes += self.br.tell() - scanStart - (self.huff.skippedBytes - skippedBytes)
+
+        self.image.scanCount += 1
+
+        if self.preview is not None and self.image.frameType == JPG.SOF2:
+            self.renderPreview()
+
+    def renderPreview(self):
+        # Samples and rgb are rebuilt from the coefficients, which stay
+        # untouched for the following scans
+        with self.stage('preview'):
+            self.image.computeEobs()
+            inverseTransform(self)
+            self.cspace.YCbCrToRGB(self.image)
+        self.preview(self.image.scanCount, self.image.rgb)
+
+    def readScanTables(self):
+        # Markers after a scan of a progressive frame: Huffman tables and the
+        # restart interval may change before the next SOS. Returns False at EOI
+        while True:
+            last = self.br.readByte()
+            current = self.br.readByte()
+            while current == 0xff:
+                current = self.br.readByte()
+
+            assert last == 0xff, 'Error - Expected a marker'
+
+            if self.instrument is not None:
+                self.instrument.marker(current, self.br.tell() - 2)
 
-        self.huff.decodeHuffmanData(self.image)
+            if current == JPG.EOI:
+                return False
+            elif current == JPG.SOS:
+                return True
+            elif current == JPG.DHT:
+                self.huff.readHuffmanTable()
+            elif current == JPG.DQT:
+                self.quant.readQuantizationTable()
+            elif current == JPG.DRI:
+                self.readRestartInterval()
+            elif current == JPG.COM or (current >= JPG.APP0 and current <= JPG.APP15):
+                self.skipSegment()
+            elif current >= JPG.RST0 and current <= JPG.RST7:
+                pass
+            else:
+                assert False, f'Error - Invalid marker between scans: {hex(current)}'
 
+    def readEndOfImage(self):
         last = self.br.readByte()
         current = self.br.readByte()
 
@@ -267,10 +399,10 @@ class Decoder:
             assert last == 0xff, 'Error - Expected a marker'
 
             if current == JPG.EOI:
+                if self.instrument is not None:
+                    self.instrument.marker(current, self.br.tell() - 2)
                 break
 
-            assert self.image.frameType != JPG.SOF2
-
             if current >= JPG.RST0 and current <= JPG.RST7:
                 pass
 
@@ -283,6 +415,27 @@ class Decoder:
             last = self.br.readByte()
             current = self.br.readByte()
 
+    def setRegion(self, roi: tuple):
+        # roi = (x, y, width, height) in frame pixels, widened to whole MCUs
+        # for decoding and cropped back after the color conversion
+        x, y, width, height = roi
+        image = self.image
+        assert width > 0 and height > 0 and x >= 0 and y >= 0 and \
+            x + width <= image.width and y + height <= image.height, f'Error - ROI outside the image: {roi}'
+
+        mcuHeight = 8 * image.verticalSamplingFactor
+        mcuWidth = 8 * image.horizontalSamplingFactor
+        row0 = y // mcuHeight
+        col0 = x // mcuWidth
+        row1 = (y + height + mcuHeight - 1) // mcuHeight
+        col1 = (x + width + mcuWidth - 1) // mcuWidth
+        image.region = (row0, row1, col0, col1)
+
+        s = image.scale
+        top = y // s - row0 * mcuHeight // s
+        left = x // s - col0 * mcuWidth // s
+        image.regionCrop = (top, left, (y + height + s - 1) // s - y // s, (x + width + s - 1) // s - x // s)
+
     def printFrameInfo(self):
         print("SOF=============")
         print(f"Frame Type: {hex(self.image.frameType)}")
@@ -298,37 +451,269 @@ class Decoder:
 
         self.quant.printInfo()
 
-def readJPG(fpath: str):
-    print(f'Reading {fpath}...')
-    br = Bitreader(fpath)
-    decoder = Decoder(br)
+def probe(fpath: str) -> JPGHeader:
+    # Frame header, restart interval and quantization tables, read with
+    # small buffered reads up to SOS; entropy-coded data is never touched.
+    # fpath may also be the file's bytes
+    with (Bitreader.fromBytes(fpath) if isinstance(fpath, (bytes, bytearray)) else StreamReader(fpath)) as br:
+        decoder = Decoder(br)
+        decoder.headerOnly = True
+        decoder.readFrameHeader()
+
+    return JPGHeader(decoder.image, decoder.quant.quantizationTables)
+
+def inverseTransform(decoder: Decoder):
+    image = decoder.image
+    if image.scale != 1:
+        with decoder.stage('inverseDCT'):
+            decoder.dct.inverseDCTScaled(image, decoder.quant.componentTables(image))
+    elif decoder.fractionBits is None:
+        with decoder.stage('dequantize'):
+            decoder.quant.dequantize(image)
+
+        with decoder.stage('inverseDCT'):
+            decoder.dct.inverseDCT(image)
+    else:
+        with decoder.stage('inverseDCT'):
+            decoder.dct.inverseDCTFixed(image, decoder.quant.componentTables(image))
+
+def openInput(source) -> Bitreader:
+    # A path is memory-mapped, bytes (e.g. a network payload) are used as is
+    if isinstance(source, (bytes, bytearray)):
+        return Bitreader.fromBytes(source)
+    return Bitreader(source)
+
+def readJPG(fpath: str, workers: int = 1, idct: str = 'numpy', fractionBits: int = None,
+            cspace: str = 'numpy', scale: int = 1, roi: tuple = None, useIndex: bool = False,
+            instrument: Instrumentation = None, preview=None):
+    with openInput(fpath) as br:
+        decoder = Decoder(br, workers, idct, fractionBits, cspace, scale, instrument)
+        decoder.preview = preview
+        if useIndex:
+            assert not isinstance(fpath, (bytes, bytearray)), 'Error - A restart index needs a file path, not bytes'
+            decoder.index = loadIndex(fpath)
+
+        with decoder.stage('header'):
+            decoder.readFrameHeader()
+
+        assert decoder.image.valid
+
+        if instrument is not None:
+            instrument.stats.fileBytes = len(br.data)
+            instrument.frame(decoder)
+
+        if roi is not None:
+            decoder.setRegion(roi)
+
+        decoder.image.allocatePlanes()
+
+        decoder.readScans()
+
+    inverseTransform(decoder)
+
+    with decoder.stage('color'):
+        if roi is None:
+            decoder.cspace.YCbCrToRGB(decoder.image)
+        else:
+            top, left, height, width = decoder.image.regionCrop
+            decoder.cspace.YCbCrToRGB(decoder.image, top + height, left + width)
+            decoder.image.rgb = decoder.image.rgb[top:, left:]
+
+    if instrument is not None:
+        instrument.finish(decoder)
+
+    return decoder.image
 
-    decoder.readFrameHeader()
+def readCoefficients(fpath: str, order: str = 'natural', workers: int = 1, useIndex: bool = False,
+                     instrument: Instrumentation = None) -> JPGCoefficients:
+    # Stops after the Huffman decoding: quantized coefficients and the
+    # quantization tables, no sample planes are allocated
+    with openInput(fpath) as br:
+        decoder = Decoder(br, workers, instrument=instrument)
+        if useIndex:
+            assert not isinstance(fpath, (bytes, bytearray)), 'Error - A restart index needs a file path, not bytes'
+            decoder.index = loadIndex(fpath)
 
-    assert decoder.image.valid
+        with decoder.stage('header'):
+            decoder.readFrameHeader()
 
-    decoder.printFrameInfo()
+        assert decoder.image.valid
 
-    decoder.image.blocks = declList(Block, int(decoder.image.blockHeightReal * decoder.image.blockWidthReal))
+        if instrument is not None:
+            instrument.stats.fileBytes = len(br.data)
+            instrument.frame(decoder)
 
-    decoder.readScans()
+        decoder.image.allocatePlanes(samples=False)
 
-    decoder.quant.dequantize(decoder.image)
+        decoder.readScans()
 
-    decoder.dct.inverseDCT(decoder.image)
+    if instrument is not None:
+        instrument.finish(decoder)
 
-    decoder.cspace.YCbCrToRGB(decoder.image)
+    return JPGCoefficients(decoder.image, decoder.quant.quantizationTables, order)
 
-    return decoder.image
+def iterRows(fpath: str, idct: str = 'numpy', fractionBits: int = None, cspace: str = 'numpy',
+             scale: int = 1, instrument: Instrumentation = None):
+    # Decodes one MCU row at a time through every stage and yields it as a
+    # (bandHeight, width, 3) uint8 band, the planes only ever hold one row
+    # The generator may be abandoned partway, the input is closed either way
+    with openInput(fpath) as br:
+        decoder = Decoder(br, 1, idct, fractionBits, cspace, scale, instrument)
+        image = decoder.image
 
-if __name__ == '__main__':
-    import sys
+        with decoder.stage('header'):
+            decoder.readFrameHeader()
+
+        assert image.valid
+
+        if instrument is not None:
+            instrument.stats.fileBytes = len(br.data)
+            instrument.frame(decoder)
+
+        assert image.frameType == JPG.SOF0, 'Error - Streaming needs a baseline frame'
+
+        decoder.readStartOfScan()
+
+        if instrument is not None:
+            instrument.scan(decoder)
 
-    fpath = sys.argv[1]
-    outpath = sys.argv[2]
+        scanStart = br.tell()
+        layout, unitRows, unitCols = decoder.huff.scanLayout(image)
+        assert len(layout) == image.numComponents, 'Error - Streaming needs every component in a single scan'
 
-    image = readJPG(fpath)
+        image.allocatePlanes(1)
+        bandHeight = image.blockSize * max(rows for _, rows, _ in layout)
+
+        decoder.huff.beginScan()
+
+        for unitRow in range(unitRows):
+            for i in range(image.numComponents):
+                image.colorComponents[i].coeffs.fill(0)
+
+            with decoder.stage('huffman'):
+                decoder.huff.decodeUnitRow(image, layout, unitRow, unitCols, 0)
+
+            inverseTransform(decoder)
+
+            with decoder.stage('color'):
+                decoder.cspace.YCbCrToRGB(image, min(bandHeight, image.outputHeight - unitRow * bandHeight))
+
+            yield image.rgb
+
+        if instrument is not None:
+            instrument.stats.entropyBytes += br.tell() - scanStart
+
+        decoder.readEndOfImage()
+
+    if instrument is not None:
+        instrument.finish(decoder)
+
+def compareFixedPoint(fpath: str, fractionBits: int):
+    # Max/mean absolute error of the fixed-point IDCT samples against the
+    # float reference, rounded the same way (+0.5, then floor)
+    with Bitreader(fpath) as br:
+        decoder = Decoder(br, fractionBits=fractionBits)
+        decoder.readFrameHeader()
+        image = decoder.image
+        image.allocatePlanes()
+        decoder.readScans()
+
+    errors = []
+    for i, qTable in enumerate(decoder.quant.componentTables(image)):
+        component: ColorComponent = image.colorComponents[i]
+        coeffs = component.coeffs.reshape(-1, 64)
+        eobs = component.eobs.reshape(-1)
+
+        fixed = decoder.dct.inverseDCTFixedBatch(coeffs, qTable.prescaled, eobs)
+        reference = coeffs * qTable.table
+        decoder.dct.inverseDCTBatch(reference, eobs)
+
+        errors.append(np.abs(fixed - np.floor(reference)))
+
+    error = np.concatenate(errors)
+    return error.max(), error.mean()
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fpath')
+    parser.add_argument('outpath', nargs='?')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='processes used to decode restart intervals')
+    parser.add_argument('--idct', choices=['numpy', 'scalar'], default='numpy',
+                        help='batched NumPy or per-block scalar IDCT')
+    parser.add_argument('--fixed-point', type=int, metavar='F', dest='fractionBits',
+                        help='integer dequantization and IDCT with F fractional bits')
+    parser.add_argument('--cspace', choices=['numpy', 'fixed', 'scalar'], default='numpy',
+                        help='color conversion: vectorized float, vectorized integer or per-pixel')
+    parser.add_argument('--report-error', action='store_true',
+                        help='print the fixed-point error against the float pipeline')
+    parser.add_argument('--scale', type=int, choices=[1, 2, 4, 8], default=1,
+                        help='decode at 1/N resolution with a reduced IDCT')
+    parser.add_argument('--roi', type=int, nargs=4, metavar=('X', 'Y', 'W', 'H'),
+                        help='decode only the blocks covering this rectangle')
+    parser.add_argument('--index', action='store_true',
+                        help='seek restart intervals through a cached .rsti index')
+    parser.add_argument('--probe', action='store_true',
+                        help='print the header fields without decoding')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='trace markers and print the frame and scan tables')
+    parser.add_argument('--stats', action='store_true',
+                        help='print stage times and entropy decoder counters')
+    parser.add_argument('--stream', action='store_true',
+                        help='decode one MCU row at a time and write a top-down BMP')
+    parser.add_argument('--raw', action='store_true',
+                        help='stream headerless RGB instead of a BMP')
+    parser.add_argument('--coefficients', choices=['natural', 'zigzag'],
+                        help='write the quantized coefficients and tables to an .npz instead of a BMP')
+    parser.add_argument('--previews', metavar='PREFIX',
+                        help='write PREFIX<n>.bmp after every scan of a progressive image')
+    args = parser.parse_args()
+
+    fpath = args.fpath
+    outpath = args.outpath
+
+    if args.report_error:
+        assert args.fractionBits is not None, 'Error - --report-error needs --fixed-point'
+        maxError, meanError = compareFixedPoint(fpath, args.fractionBits)
+        print(f'Fixed-point error ({args.fractionBits} fractional bits): max {maxError:.0f}, mean {meanError:.4f}')
+
+    if args.probe:
+        print(probe(fpath))
+        exit(0)
+
+    assert outpath is not None, 'Error - No output path given'
+
+    instrument = None
+    if args.verbose:
+        instrument = TraceInstrumentation()
+    elif args.stats:
+        instrument = Instrumentation()
 
     bmp = Bmp()
 
-    bmp.writeBMP(image, outpath)
\ No newline at end of file
+    if args.coefficients is not None:
+        coefficients = readCoefficients(fpath, args.coefficients, args.workers, args.index, instrument)
+        np.savez(outpath, **coefficients.asArrays())
+    elif args.stream or args.raw:
+        assert args.roi is None, 'Error - --roi is not supported when streaming'
+        rows = iterRows(fpath, args.idct, args.fractionBits, args.cspace, args.scale, instrument)
+        if args.raw:
+            bmp.writeRawRows(rows, outpath)
+        else:
+            bmp.writeBMPRows(rows, outpath)
+    else:
+        preview = None
+        if args.previews is not None:
+            def preview(scanCount, rgb):
+                bmp.writeBMPRows([rgb], f'{args.previews}{scanCount}.bmp')
+
+        image = readJPG(fpath, args.workers, args.idct, args.fractionBits, args.cspace, args.scale, args.roi,
+                        args.index, instrument, preview)
+
+        with nullcontext() if instrument is None else instrument.stage('writeBMP'):
+            bmp.writeBMP(image, outpath)
+
+    if args.stats:
+        printStats(instrument.stats)
\ No newline at end of file
@@ -0,0 +1,376 @@
+
+import numpy as np
+from jpg import *
+from dct import Dct
+from cspace import CSpace
+from bmp import Bmp
+
+# Annex K.1 / K.2 quantization tables, natural order, for quality 50
+LUMINANCE_QUANTIZATION = np.array([
+    16, 11, 10, 16,  24,  40,  51,  61,
+    12, 12, 14, 19,  26,  58,  60,  55,
+    14, 13, 16, 24,  40,  57,  69,  56,
+    14, 17, 22, 29,  51,  87,  80,  62,
+    18, 22, 37, 56,  68, 109, 103,  77,
+    24, 35, 55, 64,  81, 104, 113,  92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103,  99
+])
+CHROMINANCE_QUANTIZATION = np.full(64, 99)
+CHROMINANCE_QUANTIZATION.reshape(8, 8)[:4, :4] = [
+    [17, 18, 24, 47],
+    [18, 21, 26, 66],
+    [24, 26, 56, 99],
+    [47, 66, 99, 99]
+]
+
+# Annex K.3 - K.6 Huffman tables: code counts per length and symbols
+DC_LUMINANCE_BITS = [0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0]
+DC_LUMINANCE_VALUES = bytes(range(12))
+DC_CHROMINANCE_BITS = [0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0]
+DC_CHROMINANCE_VALUES = bytes(range(12))
+AC_LUMINANCE_BITS = [0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7d]
+AC_LUMINANCE_VALUES = bytes.fromhex(
+    '01020300041105122131410613516107227114328191a1082342b1c11552d1f0'
+    '2433627282090a161718191a25262728292a3435363738393a43444546474849'
+    '4a535455565758595a636465666768696a737475767778797a83848586878889'
+    '8a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5'
+    'c6c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8'
+    'f9fa')
+AC_CHROMINANCE_BITS = [0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77]
+AC_CHROMINANCE_VALUES = bytes.fromhex(
+    '000102031104052131061241510761711322328108144291a1b1c109233352f0'
+    '156272d10a162434e125f11718191a262728292a35363738393a434445464748'
+    '494a535455565758595a636465666768696a737475767778797a828384858687'
+    '88898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3'
+    'c4c5c6c7c8c9cad2d3d4d5d6d7d8d9dae2e3e4e5e6e7e8e9eaf2f3f4f5f6f7f8'
+    'f9fa')
+
+# Standard tables by Huffman table ID (0 luminance, 1 chrominance)
+STANDARD_TABLES = [
+    ((DC_LUMINANCE_BITS, DC_LUMINANCE_VALUES), (AC_LUMINANCE_BITS, AC_LUMINANCE_VALUES)),
+    ((DC_CHROMINANCE_BITS, DC_CHROMINANCE_VALUES), (AC_CHROMINANCE_BITS, AC_CHROMINANCE_VALUES))
+]
+
+# Luma (horizontal, vertical) sampling factors, chroma is always 1x1
+SAMPLING = { '444': (1, 1), '422': (2, 1), '420': (2, 2) }
+
+def scaleQuantization(table: np.ndarray, quality: int):
+    # IJG quality scaling, 50 keeps the Annex K table
+    assert 1 <= quality <= 100, f'Error - Invalid quality: {quality}'
+    scale = 5000 // quality if quality < 50 else 200 - 2 * quality
+    return np.clip((table * scale + 50) // 100, 1, 255)
+
+def huffmanCodes(bits: list, values: bytes):
+    # symbol -> code as a bit string, canonical order as in generateCodes
+    codes = {}
+    code = 0
+    k = 0
+    for length in range(1, 17):
+        for _ in range(bits[length - 1]):
+            codes[values[k]] = format(code, f'0{length}b')
+            code += 1
+            k += 1
+        code <<= 1
+    return codes
+
+def huffmanSegment(tableInfo: int, bits: list, values: bytes):
+    payload = bytes([tableInfo]) + bytes(bits) + values
+    return bytes([0xff, JPG.DHT]) + (len(payload) + 2).to_bytes(2, 'big') + payload
+
+def optimalTable(frequencies: np.ndarray):
+    # Annex K.2: code lengths from the symbol frequencies (256 entries),
+    # limited to 16 bits, with one code point reserved so no code is all
+    # ones. Returns (bits, values) like the standard tables
+    freq = [int(f) for f in frequencies] + [1]
+    codeSize = [0] * 257
+    others = [-1] * 257
+
+    while True:
+        # Least frequent symbol, the largest one on ties, then the next
+        v1 = -1
+        v2 = -1
+        for i in range(257):
+            if freq[i] and (v1 < 0 or freq[i] <= freq[v1]):
+                v1 = i
+        for i in range(257):
+            if freq[i] and i != v1 and (v2 < 0 or freq[i] <= freq[v2]):
+                v2 = i
+        if v2 < 0:
+            break
+
+        freq[v1] += freq[v2]
+        freq[v2] = 0
+
+        codeSize[v1] += 1
+        while others[v1] >= 0:
+            v1 = others[v1]
+            codeSize[v1] += 1
+        others[v1] = v2
+
+        codeSize[v2] += 1
+        while others[v2] >= 0:
+            v2 = others[v2]
+            codeSize[v2] += 1
+
+    bits = [0] * 33
+    for i in range(257):
+        if codeSize[i]:
+            bits[codeSize[i]] += 1
+
+    # Move codes longer than 16 bits up the tree (Figure K.3)
+    for i in range(32, 16, -1):
+        while bits[i] > 0:
+            j = i - 2
+            while bits[j] == 0:
+                j -= 1
+            bits[i] -= 2
+            bits[i - 1] += 1
+            bits[j + 1] += 2
+            bits[j] -= 1
+
+    # Drop the reserved code point from the longest length
+    i = 16
+    while bits[i] == 0:
+        i -= 1
+    bits[i] -= 1
+
+    values = sorted((codeSize[i], i) for i in range(256) if codeSize[i])
+    return bits[1:17], bytes(symbol for _, symbol in values)
+
+def magnitudeBits(v: int):
+    # Category and one's complement magnitude bits of a coefficient
+    category = abs(v).bit_length()
+    if category == 0:
+        return 0, ''
+    return category, format(v if v > 0 else v + (1 << category) - 1, f'0{category}b')
+
+def scanSymbols(planes: list, samplingFactors: list, tableIDs: list, restartInterval: int, unitRows: int,
+                unitCols: int):
+    # Huffman symbols of a scan over the given planes in decoding order, as
+    # (table, symbol, magnitude bits) with table = 2 * table ID + (1 for
+    # AC); None marks a restart. One plane is a non-interleaved scan of
+    # unitRows x unitCols blocks, several an interleaved one of MCUs
+    zigzag = [plane[:, :, zigZagMap] for plane in planes]
+    previousDCs = [0] * len(planes)
+    symbols = []
+
+    for unit in range(unitRows * unitCols):
+        if restartInterval != 0 and unit != 0 and unit % restartInterval == 0:
+            symbols.append(None)
+            previousDCs = [0] * len(planes)
+
+        unitRow, unitCol = divmod(unit, unitCols)
+        for i, blocks in enumerate(zigzag):
+            h, v = samplingFactors[i] if len(planes) > 1 else (1, 1)
+            dcTable = 2 * tableIDs[i]
+            acTable = dcTable + 1
+
+            unitBlocks = blocks[unitRow * v:(unitRow + 1) * v, unitCol * h:(unitCol + 1) * h]
+            for block in unitBlocks.reshape(-1, 64).tolist():
+                category, magnitude = magnitudeBits(block[0] - previousDCs[i])
+                previousDCs[i] = block[0]
+                symbols.append((dcTable, category, magnitude))
+
+                run = 0
+                for coeff in block[1:]:
+                    if coeff == 0:
+                        run += 1
+                        continue
+                    while run > 15:
+                        symbols.append((acTable, 0xf0, ''))
+                        run -= 16
+                    category, magnitude = magnitudeBits(coeff)
+                    symbols.append((acTable, (run << 4) | category, magnitude))
+                    run = 0
+                if run:
+                    symbols.append((acTable, 0x00, ''))
+
+    return symbols
+
+def encodeScan(symbols: list, codes: list):
+    # Entropy-coded segment of the symbols, codes[table] maps symbol to its
+    # code; byte-stuffed, padded with ones before every RSTn
+    data = bytearray()
+    bits = []
+    restarts = 0
+
+    def flush():
+        s = ''.join(bits)
+        s += '1' * (-len(s) % 8)
+        data.extend(int(s, 2).to_bytes(len(s) // 8, 'big').replace(b'\xff', b'\xff\x00') if s else b'')
+        bits.clear()
+
+    for entry in symbols:
+        if entry is None:
+            flush()
+            data.extend(bytes([0xff, JPG.RST0 + restarts % 8]))
+            restarts += 1
+            continue
+
+        table, symbol, magnitude = entry
+        bits.append(codes[table][symbol] + magnitude)
+
+    flush()
+    return bytes(data)
+
+def encodeCoefficients(planes: list, samplingFactors: list, qTables: list, qTableIDs: list, height: int,
+                       width: int, restartInterval: int = 0, optimize: bool = False):
+    # Baseline JPEG around quantized natural-order coefficient planes, one
+    # (blockRows, blockCols, 64) plane per component covering the MCU grid.
+    # samplingFactors are (horizontal, vertical), qTables natural-order
+    # tables indexed by qTableIDs. optimize fits the Huffman tables to the
+    # symbols in a first pass instead of using the Annex K ones
+    numComponents = len(planes)
+    tableIDs = [0] + [1] * (numComponents - 1)
+    hMax = max(h for h, _ in samplingFactors)
+    vMax = max(v for _, v in samplingFactors)
+
+    if numComponents == 1:
+        # A single component is never interleaved, its scan covers just
+        # the blocks holding pixels
+        unitRows = (height * samplingFactors[0][1] + 8 * vMax - 1) // (8 * vMax)
+        unitCols = (width * samplingFactors[0][0] + 8 * hMax - 1) // (8 * hMax)
+    else:
+        unitRows = (height + 8 * vMax - 1) // (8 * vMax)
+        unitCols = (width + 8 * hMax - 1) // (8 * hMax)
+
+    for plane, (h, v) in zip(planes, samplingFactors):
+        assert plane.shape[0] >= unitRows * v and plane.shape[1] >= unitCols * h, \
+            'Error - Coefficient plane smaller than the MCU grid'
+
+    symbols = scanSymbols(planes, samplingFactors, tableIDs, restartInterval, unitRows, unitCols)
+
+    tables = []
+    for tableID in sorted(set(tableIDs)):
+        for ac in [0, 1]:
+            bits, values = STANDARD_TABLES[tableID][ac]
+            if optimize:
+                frequencies = np.zeros(256, dtype=np.int64)
+                for entry in symbols:
+                    if entry is not None and entry[0] == 2 * tableID + ac:
+                        frequencies[entry[1]] += 1
+                if frequencies.any():
+                    bits, values = optimalTable(frequencies)
+            tables.append((2 * tableID + ac, bits, values))
+
+    codes = [None] * 4
+    for table, bits, values in tables:
+        codes[table] = huffmanCodes(bits, values)
+
+    out = bytearray([0xff, JPG.SOI])
+    out += bytes([0xff, JPG.APP0, 0, 16]) + b'JFIF\x00' + bytes([1, 1, 0, 0, 1, 0, 1, 0, 0])
+
+    for tableID in sorted(set(qTableIDs)):
+        table = qTables[tableID]
+        assert np.all(table >= 1) and np.all(table <= 255), 'Error - Only 8-bit quantization tables supported'
+        out += bytes([0xff, JPG.DQT, 0, 67, tableID]) + bytes(int(table[z]) for z in zigZagMap)
+
+    out += bytes([0xff, JPG.SOF0]) + (8 + 3 * numComponents).to_bytes(2, 'big') + bytes([8])
+    out += height.to_bytes(2, 'big') + width.to_bytes(2, 'big') + bytes([numComponents])
+    for i in range(numComponents):
+        h, v = samplingFactors[i]
+        out += bytes([i + 1, (h << 4) | v, qTableIDs[i]])
+
+    for table, bits, values in tables:
+        out += huffmanSegment(((table & 1) << 4) | (table >> 1), bits, values)
+
+    if restartInterval != 0:
+        out += bytes([0xff, JPG.DRI, 0, 4]) + restartInterval.to_bytes(2, 'big')
+
+    out += bytes([0xff, JPG.SOS]) + (6 + 2 * numComponents).to_bytes(2, 'big') + bytes([numComponents])
+    for i in range(numComponents):
+        out += bytes([i + 1, (tableIDs[i] << 4) | tableIDs[i]])
+    out += bytes([0, 63, 0])
+
+    out += encodeScan(symbols, codes)
+    out += bytes([0xff, JPG.EOI])
+    return bytes(out)
+
+class Encoder:
+
+    def __init__(self, quality: int = 75, sampling: str = '420', restartInterval: int = 0,
+                 optimize: bool = False) -> None:
+        assert sampling in SAMPLING, f'Error - Unsupported sampling: {sampling}'
+        assert 0 <= restartInterval <= 0xffff, f'Error - Invalid restart interval: {restartInterval}'
+        self.sampling = sampling
+        self.restartInterval = restartInterval
+        self.optimize = optimize
+        self.qTables = [scaleQuantization(LUMINANCE_QUANTIZATION, quality),
+                        scaleQuantization(CHROMINANCE_QUANTIZATION, quality)]
+        self.dct = Dct()
+        self.cspace = CSpace()
+
+    def forwardTransform(self, plane: np.ndarray, qTable: np.ndarray):
+        # (8 * blockRows, 8 * blockCols) samples -> quantized coefficients
+        blockRows, blockCols = plane.shape[0] // 8, plane.shape[1] // 8
+        blocks = plane.reshape(blockRows, 8, blockCols, 8).transpose(0, 2, 1, 3).reshape(-1, 8, 8)
+        coeffs = np.rint(self.dct.forwardDCTBatch(blocks) / qTable)
+        return coeffs.astype(np.int16).reshape(blockRows, blockCols, 64)
+
+    def encode(self, pixels: np.ndarray):
+        # (height, width, 3) RGB or (height, width) grayscale uint8 -> bytes
+        height, width = pixels.shape[:2]
+
+        if pixels.ndim == 2:
+            hMax, vMax = 1, 1
+            samplingFactors = [(1, 1)]
+            qTableIDs = [0]
+        else:
+            hMax, vMax = SAMPLING[self.sampling]
+            samplingFactors = [(hMax, vMax), (1, 1), (1, 1)]
+            qTableIDs = [0, 1, 1]
+
+        # Pad to whole MCUs by repeating the last row and column
+        mcuHeight = 8 * vMax
+        mcuWidth = 8 * hMax
+        padding = ((0, -height % mcuHeight), (0, -width % mcuWidth))
+
+        if pixels.ndim == 2:
+            planes = [np.pad(pixels, padding, mode='edge').astype(np.float64) - 128]
+        else:
+            planes = self.cspace.RGBToYCbCr(np.pad(pixels, padding + ((0, 0),), mode='edge'))
+            # Chroma is averaged over each luma MCU's hMax x vMax pixel cells
+            for i in [1, 2]:
+                rows, cols = planes[i].shape
+                planes[i] = planes[i].reshape(rows // vMax, vMax, cols // hMax, hMax).mean(axis=(1, 3))
+
+        coeffs = [self.forwardTransform(plane, self.qTables[qTableIDs[i]]) for i, plane in enumerate(planes)]
+
+        return encodeCoefficients(coeffs, samplingFactors, self.qTables, qTableIDs, height, width,
+                                  self.restartInterval, self.optimize)
+
+    def writeJPG(self, pixels: np.ndarray, fpath):
+        data = self.encode(pixels)
+        with open(fpath, 'wb') as f:
+            f.write(data)
+            f.close()
+        return len(data)
+
+if __name__ == '__main__':
+    import argparse
+    from decoder import readJPG
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fpath', help='24-bit BMP, or a JPEG to re-encode')
+    parser.add_argument('outpath')
+    parser.add_argument('-q', '--quality', type=int, default=75)
+    parser.add_argument('--sampling', choices=list(SAMPLING), default='420')
+    parser.add_argument('--restart-interval', type=int, default=0, dest='restartInterval',
+                        help='MCUs between RSTn markers, 0 for none')
+    parser.add_argument('--optimize', action='store_true',
+                        help='fit the Huffman tables to the image in a second pass')
+    parser.add_argument('--gray', action='store_true', help='encode the luma only')
+    args = parser.parse_args()
+
+    if args.fpath.lower().endswith(('.jpg', '.jpeg')):
+        pixels = readJPG(args.fpath).rgb
+    else:
+        pixels = Bmp().readBMP(args.fpath)
+
+    if args.gray:
+        pixels = np.clip(np.rint(CSpace().RGBToYCbCr(pixels)[0] + 128), 0, 255).astype(np.uint8)
+
+    encoder = Encoder(args.quality, args.sampling, args.restartInterval, args.optimize)
+    size = encoder.writeJPG(pixels, args.outpath)
+    print(f'{args.outpath}: {size} bytes')
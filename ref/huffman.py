@@ -1,22 +1,82 @@
 
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from bitreader import *
 from jpg import *
 
+def wrapCoefficient(value: int):
+    # Coefficient planes are int16: out-of-range values wrap around, like
+    # libjpeg's JCOEF cast, instead of failing the store
+    return ((value + 32768) & 0xffff) - 32768
+
 class HuffmanTable:
     offsets: np.ndarray
     symbols: np.ndarray
     codes: np.ndarray
+    # (length << 8) | symbol for every LOOKUP_BITS-bit prefix, 0 if longer
+    lookup: list
+    # Largest code of each length (-1 if none) and index of its first symbol
+    maxCode: list
+    valOffset: list
     set: bool = False
 
+class HuffmanTableCache:
+    # Built tables keyed by their raw DHT bytes (16 code counts and the
+    # symbols), least recently used first. Tables are never modified once
+    # built, so decoders share them
+
+    def __init__(self, capacity: int = 64) -> None:
+        self.capacity = capacity
+        self.tables = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: bytes):
+        hTable = self.tables.get(key)
+        if hTable is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.tables.move_to_end(key)
+        return hTable
+
+    def put(self, key: bytes, hTable: HuffmanTable):
+        self.tables[key] = hTable
+        self.tables.move_to_end(key)
+        while len(self.tables) > self.capacity:
+            self.tables.popitem(last=False)
+
+    def clear(self):
+        self.tables.clear()
+        self.hits = 0
+        self.misses = 0
+
+# Process-wide, most files come from a few encoders with identical tables
+tableCache = HuffmanTableCache()
+
 class HuffmanDecoder:
+    LOOKUP_BITS = 9
+
     dcTables: list = [ HuffmanTable() for _ in range(4) ]
     acTables: list = [ HuffmanTable() for _ in range(4) ]
 
     br: Bitreader
-
-    def __init__(self, br: Bitreader) -> None:
+    previousDCs: list = [0] * 3
+    # Only DC coefficients are kept, AC values are skipped (1/8 scale)
+    dcOnly: bool = False
+    # Remaining blocks of a progressive AC band that end with an EOB
+    eobRun: int = 0
+    # Entropy-coded bytes jumped over without being decoded
+    skippedBytes: int = 0
+
+    def __init__(self, br: Bitreader, dcOnly: bool = False) -> None:
         self.br = br
+        self.previousDCs = [0] * 3
+        self.dcOnly = dcOnly
+        self.dcTables = [ HuffmanTable() for _ in range(4) ]
+        self.acTables = [ HuffmanTable() for _ in range(4) ]
 
     def generateCodes(self, offsets: np.ndarray, codes: np.ndarray):
         code = 0
@@ -28,56 +88,100 @@ class HuffmanDecoder:
         return codes
 
     def readHuffmanTable(self):
-        print('Reading DHT Marker')
         length = self.br.readWord()
-        length -= 2
+        assert length >= 2, 'Error - DHT invalid'
+        payload = self.br.readSegment(length - 2)
+        offset = 0
 
-        while length > 0:
-            tableInfo = self.br.readByte()
+        while offset < len(payload):
+            tableInfo = payload[offset]
             tableID = tableInfo & 0x0f
             acTable = tableInfo >> 4
 
             assert tableID <= 3, f'Error - Invalid Huffman table ID: {tableID}'
+            assert offset + 17 <= len(payload), 'Error - DHT invalid'
 
-            hTable: HuffmanTable = self.acTables[tableID] if acTable else self.dcTables[tableID]
-            assert not hTable.set
-            hTable.set = True
+            allSymbols = sum(payload[offset + 1:offset + 17])
 
-            hTable.offsets = np.zeros(17, dtype=np.int32)
-            hTable.symbols = np.zeros(176, dtype=np.int32)
-            hTable.codes = np.zeros(176, dtype=np.int32)
+            assert allSymbols <= 176, f'Error - Too many symbols in Huffman table: {allSymbols}'
+            assert offset + 17 + allSymbols <= len(payload), 'Error - DHT invalid'
 
-            hTable.offsets[0] = 0
-            allSymbols = 0
-            for i in range(1, 17):
-                allSymbols += self.br.readByte()
-                hTable.offsets[i] = allSymbols
+            key = bytes(payload[offset + 1:offset + 17 + allSymbols])
+            hTable = tableCache.get(key)
+            if hTable is None:
+                hTable = self.buildTable(key)
+                tableCache.put(key, hTable)
 
-            assert allSymbols <= 176, f'Error - Too many symbols in Huffman table: {allSymbols}'
+            # Tables may be redefined between scans, the new one replaces it
+            if acTable:
+                self.acTables[tableID] = hTable
+            else:
+                self.dcTables[tableID] = hTable
 
-            for i in range(allSymbols):
-                hTable.symbols[i] = self.br.readByte()
+            offset += 17 + allSymbols
 
-            self.generateCodes(hTable.offsets, hTable.codes)
+    def buildTable(self, key: bytes):
+        # key: the 16 code counts followed by the symbols, as in DHT
+        hTable = HuffmanTable()
+        hTable.set = True
 
-            length -= 17 + allSymbols
+        hTable.offsets = np.zeros(17, dtype=np.int32)
+        hTable.symbols = np.zeros(176, dtype=np.int32)
+        hTable.codes = np.zeros(176, dtype=np.int32)
 
-    def getNextSymbol(self, hTable: HuffmanTable):
-        currentCode = 0
+        hTable.offsets[1:] = np.cumsum(np.frombuffer(key[:16], dtype=np.uint8))
+        hTable.symbols[:len(key) - 16] = np.frombuffer(key[16:], dtype=np.uint8)
+
+        self.generateCodes(hTable.offsets, hTable.codes)
+        self.buildLookup(hTable)
+        return hTable
+
+    def buildLookup(self, hTable: HuffmanTable):
+        k = self.LOOKUP_BITS
+        hTable.lookup = [0] * (1 << k)
+        hTable.maxCode = [-1] * 17
+        hTable.valOffset = [0] * 17
 
         for i in range(16):
-            bit = self.br.readBit()
-            currentCode = (currentCode << 1) | bit
-            for j in range(hTable.offsets[i], hTable.offsets[i+1]):
-                if currentCode == hTable.codes[j]:
-                    return hTable.symbols[j]
-                
+            codeLength = i + 1
+            first = int(hTable.offsets[i])
+            last = int(hTable.offsets[i + 1])
+            if first == last:
+                continue
+
+            hTable.maxCode[codeLength] = int(hTable.codes[last - 1])
+            hTable.valOffset[codeLength] = first - int(hTable.codes[first])
+
+            if codeLength > k:
+                continue
+
+            for j in range(first, last):
+                entry = (codeLength << 8) | int(hTable.symbols[j])
+                prefix = int(hTable.codes[j]) << (k - codeLength)
+                for fill in range(1 << (k - codeLength)):
+                    hTable.lookup[prefix | fill] = entry
+
+    def getNextSymbol(self, hTable: HuffmanTable):
+        entry = hTable.lookup[self.br.peekBits(self.LOOKUP_BITS)]
+        if entry:
+            self.br.skipBits(entry >> 8)
+            return entry & 0xff
+
+        # Codes longer than the lookup prefix
+        currentCode = self.br.peekBits(16)
+        for codeLength in range(self.LOOKUP_BITS + 1, 17):
+            code = currentCode >> (16 - codeLength)
+            if code <= hTable.maxCode[codeLength]:
+                self.br.skipBits(codeLength)
+                return int(hTable.symbols[hTable.valOffset[codeLength] + code])
+
         assert False, 'getNextSymbol: No such symbol'
 
 
     def decodeBlockComponent(self, previousDC,
-                            dcTableId, acTableId):
-    
+                            dcTableId, acTableId, block: np.ndarray):
+        # block: zeroed 64-entry view of the component's coefficient plane
+
         dcTable: HuffmanTable = self.dcTables[dcTableId]
         acTable: HuffmanTable = self.acTables[acTableId]
 
@@ -89,10 +193,11 @@ class HuffmanDecoder:
         if length != 0 and coeff < (1 << (length - 1)):
             coeff -= (1 << length) - 1
 
-        block = np.zeros(64)
+        previousDC = coeff + previousDC
+        block[0] = wrapCoefficient(previousDC)
 
-        block[0] = coeff + previousDC
-        previousDC = block[0]
+        # Zigzag index of the last non-zero coefficient
+        eob = 0
 
         i = 1
         while i < 64:
@@ -118,66 +223,375 @@ class HuffmanDecoder:
                 if coeffLength and coeff < (1 << (coeffLength - 1)):
                     coeff -= (1 << coeffLength) - 1
 
+                # Fits int16 as is: the length is at most 10 bits
                 block[zigZagMap[i]] = coeff
+                eob = i
 
             i += 1
 
-        return previousDC, block
+        return previousDC, eob
 
-    def decodeHuffmanData(self, image: JPGImage):
-        luminanceOnly = image.componentsInScan == 1 and image.colorComponents[0].usedInScan
-        yStep = 1 if luminanceOnly else image.verticalSamplingFactor
-        xStep = 1 if luminanceOnly else image.horizontalSamplingFactor
+    def skipBlockComponent(self, previousDC,
+                           dcTableId, acTableId, block: np.ndarray):
+        # Same bitstream walk as decodeBlockComponent, but AC values are
+        # skipped instead of read, sign-extended and stored
 
-        if yStep != 1 or xStep != 1:
-            assert False, 'Not Supported'
-            self.decodeHuffmanDataSample(image)
-        else:
-            self.decodeHuffmanDataNoSample(image)
+        dcTable: HuffmanTable = self.dcTables[dcTableId]
+        acTable: HuffmanTable = self.acTables[acTableId]
 
-    def decodeHuffmanDataSample(self, image: JPGImage):
-        previousDCs = [0] * 3
+        length = self.getNextSymbol(dcTable)
 
-        luminanceOnly = image.componentsInScan == 1 and image.colorComponents[0].usedInScan
-        yStep = 1 if luminanceOnly else image.verticalSamplingFactor
-        xStep = 1 if luminanceOnly else image.horizontalSamplingFactor
-        restartInterval = int(image.restartInterval * xStep * yStep)
+        assert length <= 11, 'Error - DC coefficient length greater than 11'
+        coeff = self.br.readBits(length)
 
-        for y in range(0, image.blockHeight, yStep):
-            for x in range(0, image.blockWidth, xStep):
-                if restartInterval != 0 and ((y * image.blockWidthReal + x) % restartInterval) == 0:
-                    previousDCs = [0] * 3
-                    self.br.align()
+        if length != 0 and coeff < (1 << (length - 1)):
+            coeff -= (1 << length) - 1
 
-                for i in range(image.numComponents):
-                    component: ColorComponent = image.colorComponents[i]
-                    if component.usedInScan:
+        previousDC = coeff + previousDC
+        block[0] = wrapCoefficient(previousDC)
 
-                        for v in range(yStep):
-                            for h in range(xStep):
-                                previousDCs[i], block = self.decodeBlockComponent(
-                                        previousDCs[i],
-                                        component.huffmanDCTableID,
-                                        component.huffmanACTableID)
+        i = 1
+        while i < 64:
+            symbol = self.getNextSymbol(acTable)
 
-                                image.blocks[(y + v) * image.blockWidthReal + (x + h)][i] = block
+            if symbol == 0:
+                break
+
+            i += symbol >> 4
+
+            assert i < 64, 'Error - Zero run-length exceeded block component'
 
+            self.br.skipBits(symbol & 0x0F)
 
-    def decodeHuffmanDataNoSample(self, image: JPGImage):
-        previousDCs = [0] * 3
+            i += 1
+
+        return previousDC, 0
+
+    def scanLayout(self, image: JPGImage):
+        # Decoding units of the current scan: an MCU of every component for
+        # interleaved scans, a single block for non-interleaved ones. Returns
+        # (componentIndex, blockRows, blockCols) per unit and the unit grid
+        components = [i for i in range(image.numComponents) if image.colorComponents[i].usedInScan]
+
+        if len(components) == 1:
+            component: ColorComponent = image.colorComponents[components[0]]
+            height = (image.height * component.verticalSamplingFactor + image.verticalSamplingFactor - 1) \
+                // image.verticalSamplingFactor
+            width = (image.width * component.horizontalSamplingFactor + image.horizontalSamplingFactor - 1) \
+                // image.horizontalSamplingFactor
+            return [(components[0], 1, 1)], (height + 7) // 8, (width + 7) // 8
+
+        layout = [(i, image.colorComponents[i].verticalSamplingFactor, image.colorComponents[i].horizontalSamplingFactor)
+                  for i in components]
+        return layout, image.blockHeightReal // image.verticalSamplingFactor, \
+            image.blockWidthReal // image.horizontalSamplingFactor
+
+    def beginScan(self):
+        self.previousDCs = [0] * 3
+        self.eobRun = 0
+
+    def decodeUnitRow(self, image: JPGImage, layout: list, unitRow: int, unitCols: int, planeRow: int):
+        # Decode one row of units into block row planeRow of the planes, DC
+        # predictors carry over between rows until the next restart marker
+        previousDCs = self.previousDCs
         restartInterval = image.restartInterval
-        for nb in range(len(image.blocks)):
-            if restartInterval != 0 and (nb % restartInterval) == 0:
+        decodeBlock = self.skipBlockComponent if self.dcOnly else self.decodeBlockComponent
+
+        for unitCol in range(unitCols):
+            unit = unitRow * unitCols + unitCol
+            if restartInterval != 0 and (unit % restartInterval) == 0:
                 previousDCs = [0] * 3
                 self.br.align()
 
-            for i in range(image.numComponents):
+            for i, rows, cols in layout:
                 component: ColorComponent = image.colorComponents[i]
-                previousDCs[i], block = self.decodeBlockComponent(
+                for v in range(rows):
+                    for h in range(cols):
+                        y = planeRow * rows + v
+                        x = unitCol * cols + h
+                        previousDCs[i], component.eobs[y, x] = decodeBlock(
                                         previousDCs[i],
                                         component.huffmanDCTableID,
-                                        component.huffmanACTableID)
-                image.blocks[nb][i] = block
+                                        component.huffmanACTableID,
+                                        component.coeffs[y, x])
+
+        self.previousDCs = previousDCs
+
+    def decodeHuffmanData(self, image: JPGImage):
+        layout, unitRows, unitCols = self.scanLayout(image)
+        self.beginScan()
+
+        for unitRow in range(unitRows):
+            self.decodeUnitRow(image, layout, unitRow, unitCols, unitRow)
+
+    def decodeUnitRange(self, image: JPGImage, layout: list, unitCols: int, start: int, stop: int, window: tuple):
+        # Decode units [start, stop), storing the ones inside window =
+        # (row0, row1, col0, col1) of the unit grid; the others are only
+        # walked for their DC predictors
+        row0, row1, col0, col1 = window
+        restartInterval = image.restartInterval
+        decodeBlock = self.skipBlockComponent if self.dcOnly else self.decodeBlockComponent
+        scratch = np.zeros(64, dtype=np.int16)
+
+        for unit in range(start, stop):
+            if restartInterval != 0 and (unit % restartInterval) == 0:
+                self.previousDCs = [0] * 3
+                self.br.align()
+
+            unitRow, unitCol = divmod(unit, unitCols)
+            inside = row0 <= unitRow < row1 and col0 <= unitCol < col1
+
+            for i, rows, cols in layout:
+                component: ColorComponent = image.colorComponents[i]
+                for v in range(rows):
+                    for h in range(cols):
+                        if inside:
+                            y = (unitRow - row0) * rows + v
+                            x = (unitCol - col0) * cols + h
+                            self.previousDCs[i], component.eobs[y, x] = decodeBlock(
+                                            self.previousDCs[i],
+                                            component.huffmanDCTableID,
+                                            component.huffmanACTableID,
+                                            component.coeffs[y, x])
+                        else:
+                            self.previousDCs[i], _ = self.skipBlockComponent(
+                                            self.previousDCs[i],
+                                            component.huffmanDCTableID,
+                                            component.huffmanACTableID,
+                                            scratch)
+
+    def decodeHuffmanDataRegion(self, image: JPGImage, restarts: tuple = None):
+        # Decode only the units covering image.region. With restart markers
+        # the intervals outside it are skipped without being decoded,
+        # otherwise decoding stops after the last unit of the region
+        layout, unitRows, unitCols = self.scanLayout(image)
+        row0, row1, col0, col1 = image.region
+
+        if len(layout) == 1:
+            # Non-interleaved scan, the unit grid is the component's block grid
+            component: ColorComponent = image.colorComponents[layout[0][0]]
+            v = component.verticalSamplingFactor
+            h = component.horizontalSamplingFactor
+            row0, row1, col0, col1 = row0 * v, min(row1 * v, unitRows), col0 * h, min(col1 * h, unitCols)
+
+        window = (row0, row1, col0, col1)
+        first = row0 * unitCols + col0
+        last = (row1 - 1) * unitCols + col1
+        numUnits = unitRows * unitCols
+        restartInterval = image.restartInterval
+        self.beginScan()
+
+        if restartInterval != 0:
+            intervals, end = restarts if restarts is not None else self.br.scanRestartMarkers()
+            if len(intervals) == (numUnits + restartInterval - 1) // restartInterval:
+                decodedBytes = 0
+                for k in range(first // restartInterval, (last - 1) // restartInterval + 1):
+                    start = k * restartInterval
+                    stop = min(start + restartInterval, numUnits)
+                    # Intervals between the first and last unit may still
+                    # miss the region's columns
+                    unitRow, unitCol = np.divmod(np.arange(start, stop), unitCols)
+                    if not np.any((unitRow >= row0) & (unitRow < row1) & (unitCol >= col0) & (unitCol < col1)):
+                        continue
+                    self.br.seek(intervals[k][0])
+                    self.decodeUnitRange(image, layout, unitCols, start, stop, window)
+                    decodedBytes += (intervals[k + 1][0] if k + 1 < len(intervals) else end) - intervals[k][0]
+                self.skippedBytes += end - intervals[0][0] - decodedBytes
+                self.br.seek(end)
+                return
+
+        self.decodeUnitRange(image, layout, unitCols, 0, last, window)
+        self.skipSegment()
+
+    def skipSegment(self):
+        start = self.br.tell()
+        self.br.skipSegment()
+        self.skippedBytes += self.br.tell() - start
+
+    def decodeHuffmanDataParallel(self, image: JPGImage, workers: int, restarts: tuple = None):
+        # restarts: (intervals, end) from a restart index, saves the scan
+        intervals, end = restarts if restarts is not None else self.br.scanRestartMarkers()
+        layout, unitRows, unitCols = self.scanLayout(image)
+        numUnits = unitRows * unitCols
+        restartInterval = image.restartInterval
+
+        if len(intervals) != (numUnits + restartInterval - 1) // restartInterval:
+            # Markers missing or corrupt, fall back to a sequential decode
+            self.decodeHuffmanData(image)
+            return
+
+        workerLayout = [(rows, cols, image.colorComponents[i].huffmanDCTableID, image.colorComponents[i].huffmanACTableID)
+                        for i, rows, cols in layout]
+        tasks = [(bytes(self.br.data[start:stop]), min(restartInterval, numUnits - k * restartInterval))
+                 for k, (start, stop) in enumerate(intervals)]
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=initIntervalWorker,
+                                 initargs=(type(self), self.dcTables, self.acTables, workerLayout, self.dcOnly)) as pool:
+            chunksize = max(1, len(tasks) // (4 * workers))
+            for k, (results, counts) in enumerate(pool.map(decodeRestartInterval, tasks, chunksize=chunksize)):
+                if counts is not None:
+                    self.addCounts(counts)
+                unitRow, unitCol = np.divmod(np.arange(k * restartInterval, k * restartInterval + tasks[k][1]), unitCols)
+                for (i, rows, cols), (blocks, eobs) in zip(layout, results):
+                    component: ColorComponent = image.colorComponents[i]
+                    y = unitRow[:, None, None] * rows + np.arange(rows)[None, :, None]
+                    x = unitCol[:, None, None] * cols + np.arange(cols)[None, None, :]
+                    component.coeffs[y, x] = blocks
+                    component.eobs[y, x] = eobs
+
+        self.br.seek(end)
+
+    def decodeDCFirst(self, previousDC, component: ColorComponent, block: np.ndarray, image: JPGImage):
+        dcTable: HuffmanTable = self.dcTables[component.huffmanDCTableID]
+
+        length = self.getNextSymbol(dcTable)
+
+        assert length <= 11, 'Error - DC coefficient length greater than 11'
+        coeff = self.br.readBits(length)
+
+        if length != 0 and coeff < (1 << (length - 1)):
+            coeff -= (1 << length) - 1
+
+        previousDC = coeff + previousDC
+        block[0] = wrapCoefficient(previousDC << image.successiveApproximationLow)
+        return previousDC
+
+    def decodeDCRefinement(self, previousDC, component: ColorComponent, block: np.ndarray, image: JPGImage):
+        if self.br.readBit():
+            block[0] = wrapCoefficient(int(block[0]) | 1 << image.successiveApproximationLow)
+        return previousDC
+
+    def decodeACFirst(self, previousDC, component: ColorComponent, block: np.ndarray, image: JPGImage):
+        # Coefficients startOfSelection..endOfSelection of one block, or
+        # nothing while an EOB run is pending
+        if self.eobRun > 0:
+            self.eobRun -= 1
+            return previousDC
+
+        acTable: HuffmanTable = self.acTables[component.huffmanACTableID]
+        al = image.successiveApproximationLow
+        end = image.endOfSelection
+
+        i = image.startOfSelection
+        while i <= end:
+            symbol = self.getNextSymbol(acTable)
+
+            numZeroes = symbol >> 4
+            coeffLength = symbol & 0x0F
+
+            if coeffLength:
+                i += numZeroes
+
+                assert i <= end, 'Error - Zero run-length exceeded spectral selection'
+                assert coeffLength <= 10, 'Error - AC coefficient length greater than 10'
+
+                coeff = self.br.readBits(coeffLength)
+
+                if coeff < (1 << (coeffLength - 1)):
+                    coeff -= (1 << coeffLength) - 1
+
+                block[zigZagMap[i]] = wrapCoefficient(coeff << al)
+            elif numZeroes == 15:
+                i += 15
+            else:
+                # EOBn: this block and the next 2^n - 1 + extra bits ones end here
+                self.eobRun = (1 << numZeroes) - 1
+                if numZeroes:
+                    self.eobRun += self.br.readBits(numZeroes)
+                break
+
+            i += 1
+
+        return previousDC
+
+    def refineNonZeroes(self, block: np.ndarray, i: int, end: int, zeroes: int, p1: int):
+        # Walk coefficients from i, reading a correction bit for every
+        # non-zero one, until zeroes + 1 zero coefficients have been seen
+        # (or end). Returns the index of that zero coefficient
+        while i <= end:
+            z = zigZagMap[i]
+            if block[z] != 0:
+                if self.br.readBit() and (block[z] & p1) == 0:
+                    block[z] = wrapCoefficient(int(block[z]) + (p1 if block[z] >= 0 else -p1))
+            else:
+                if zeroes == 0:
+                    break
+                zeroes -= 1
+            i += 1
+        return i
+
+    def decodeACRefinement(self, previousDC, component: ColorComponent, block: np.ndarray, image: JPGImage):
+        # One more bit of every coefficient in the band: new coefficients
+        # of magnitude 1 are placed among the zeroes, the non-zero ones
+        # passed over get a correction bit
+        acTable: HuffmanTable = self.acTables[component.huffmanACTableID]
+        p1 = 1 << image.successiveApproximationLow
+        end = image.endOfSelection
+
+        i = image.startOfSelection
+        if self.eobRun == 0:
+            while i <= end:
+                symbol = self.getNextSymbol(acTable)
+
+                numZeroes = symbol >> 4
+                coeffLength = symbol & 0x0F
+                coeff = 0
+
+                if coeffLength:
+                    assert coeffLength == 1, 'Error - Invalid AC refinement coefficient length'
+                    coeff = p1 if self.br.readBit() else -p1
+                elif numZeroes != 15:
+                    self.eobRun = 1 << numZeroes
+                    if numZeroes:
+                        self.eobRun += self.br.readBits(numZeroes)
+                    break
+
+                i = self.refineNonZeroes(block, i, end, numZeroes, p1)
+                if coeff:
+                    assert i <= end, 'Error - Zero run-length exceeded spectral selection'
+                    block[zigZagMap[i]] = coeff
+
+                i += 1
+
+        if self.eobRun > 0:
+            self.refineNonZeroes(block, i, end, 64, p1)
+            self.eobRun -= 1
+
+        return previousDC
+
+    def decodeProgressiveScan(self, image: JPGImage):
+        # One scan of a progressive frame into the persistent coefficient
+        # planes: a DC or AC band (spectral selection), first pass or one
+        # more bit of it (successive approximation)
+        if image.startOfSelection == 0:
+            decodeBlock = self.decodeDCFirst if image.successiveApproximationHigh == 0 else self.decodeDCRefinement
+        else:
+            if self.dcOnly:
+                # 1/8 scale output only needs the DC scans
+                self.skipSegment()
+                return
+            decodeBlock = self.decodeACFirst if image.successiveApproximationHigh == 0 else self.decodeACRefinement
+
+        layout, unitRows, unitCols = self.scanLayout(image)
+        restartInterval = image.restartInterval
+        self.beginScan()
+        previousDCs = self.previousDCs
+
+        for unit in range(unitRows * unitCols):
+            if restartInterval != 0 and (unit % restartInterval) == 0:
+                previousDCs = [0] * 3
+                self.eobRun = 0
+                self.br.align()
+
+            unitRow, unitCol = divmod(unit, unitCols)
+            for i, rows, cols in layout:
+                component: ColorComponent = image.colorComponents[i]
+                for v in range(rows):
+                    for h in range(cols):
+                        previousDCs[i] = decodeBlock(previousDCs[i], component,
+                                                     component.coeffs[unitRow * rows + v, unitCol * cols + h], image)
+
+        self.previousDCs = previousDCs
 
     def printScanInfo(self):
         print("DHT=============\n")
@@ -201,4 +615,128 @@ class HuffmanDecoder:
                     print(f"{(j + 1)}: ", end='')
                     for k in range(hf.offsets[j], hf.offsets[j + 1]):
                         print(f"{hex(hf.symbols[k])} ", end='')
-                    print("")
\ No newline at end of file
+                    print("")
+
+class CountingHuffmanDecoder(HuffmanDecoder):
+    # Counts symbols, zero runs and EOBs as they are decoded, for
+    # instrumented decodes; the plain decoder carries no bookkeeping. Every
+    # block decoder first tells getNextSymbol where its AC symbols start
+
+    def __init__(self, br: Bitreader, dcOnly: bool = False) -> None:
+        super().__init__(br, dcOnly)
+        self.blocks = 0
+        self.symbols = 0
+        # Zeros before every non-zero AC coefficient, since the previous one
+        # or the start of the band
+        self.zeroRuns = [0] * 63
+        # Zigzag index of the last non-zero coefficient of sequential blocks
+        self.eobCounts = [0] * 64
+        # Zigzag index of the next AC coefficient, 0 while the DC symbol of
+        # a sequential block is pending, -1 when AC symbols are not tracked
+        self.acIndex = -1
+        self.zeroes = 0
+        self.lastNonZero = 0
+
+    def takeCounts(self):
+        counts = (self.blocks, self.symbols, self.zeroRuns, self.eobCounts)
+        self.blocks = 0
+        self.symbols = 0
+        self.zeroRuns = [0] * 63
+        self.eobCounts = [0] * 64
+        return counts
+
+    def addCounts(self, counts: tuple):
+        blocks, symbols, zeroRuns, eobCounts = counts
+        self.blocks += blocks
+        self.symbols += symbols
+        self.zeroRuns = [a + b for a, b in zip(self.zeroRuns, zeroRuns)]
+        self.eobCounts = [a + b for a, b in zip(self.eobCounts, eobCounts)]
+
+    def getNextSymbol(self, hTable: HuffmanTable):
+        symbol = super().getNextSymbol(hTable)
+        self.symbols += 1
+
+        if self.acIndex > 0:
+            numZeroes = symbol >> 4
+            if symbol & 0x0F:
+                self.acIndex += numZeroes
+                self.zeroRuns[min(self.zeroes + numZeroes, 62)] += 1
+                self.zeroes = 0
+                self.lastNonZero = self.acIndex
+                self.acIndex += 1
+            elif numZeroes == 15:
+                self.zeroes += 16
+                self.acIndex += 16
+        elif self.acIndex == 0:
+            self.acIndex = 1
+
+        return symbol
+
+    def beginBlock(self, acIndex: int):
+        self.blocks += 1
+        self.acIndex = acIndex
+        self.zeroes = 0
+        self.lastNonZero = 0
+
+    def decodeBlockComponent(self, previousDC, dcTableId, acTableId, block: np.ndarray):
+        self.beginBlock(0)
+        result = super().decodeBlockComponent(previousDC, dcTableId, acTableId, block)
+        self.eobCounts[self.lastNonZero] += 1
+        return result
+
+    def skipBlockComponent(self, previousDC, dcTableId, acTableId, block: np.ndarray):
+        self.beginBlock(0)
+        result = super().skipBlockComponent(previousDC, dcTableId, acTableId, block)
+        self.eobCounts[self.lastNonZero] += 1
+        return result
+
+    def decodeDCFirst(self, previousDC, component: ColorComponent, block: np.ndarray, image: JPGImage):
+        self.beginBlock(-1)
+        return super().decodeDCFirst(previousDC, component, block, image)
+
+    def decodeDCRefinement(self, previousDC, component: ColorComponent, block: np.ndarray, image: JPGImage):
+        self.beginBlock(-1)
+        return super().decodeDCRefinement(previousDC, component, block, image)
+
+    def decodeACFirst(self, previousDC, component: ColorComponent, block: np.ndarray, image: JPGImage):
+        self.beginBlock(image.startOfSelection)
+        return super().decodeACFirst(previousDC, component, block, image)
+
+    def decodeACRefinement(self, previousDC, component: ColorComponent, block: np.ndarray, image: JPGImage):
+        # Refinement symbols are counted, their runs skip over non-zero
+        # coefficients and are not zero runs
+        self.beginBlock(-1)
+        return super().decodeACRefinement(previousDC, component, block, image)
+
+# Per-process state of the restart interval workers
+intervalDecoder: HuffmanDecoder = None
+intervalLayout: list = []
+
+def initIntervalWorker(decoderClass, dcTables, acTables, layout, dcOnly):
+    global intervalDecoder, intervalLayout
+    intervalDecoder = decoderClass(None, dcOnly)
+    intervalDecoder.dcTables = dcTables
+    intervalDecoder.acTables = acTables
+    intervalLayout = layout
+
+def decodeRestartInterval(task):
+    data, numUnits = task
+    intervalDecoder.br = Bitreader.fromBytes(data)
+
+    previousDCs = [0] * len(intervalLayout)
+    results = [(np.zeros((numUnits, rows, cols, 64), dtype=np.int16), np.zeros((numUnits, rows, cols), dtype=np.int8))
+               for rows, cols, _, _ in intervalLayout]
+    decodeBlock = intervalDecoder.skipBlockComponent if intervalDecoder.dcOnly else intervalDecoder.decodeBlockComponent
+    for unit in range(numUnits):
+        for n, (rows, cols, dcTableId, acTableId) in enumerate(intervalLayout):
+            blocks, eobs = results[n]
+            for v in range(rows):
+                for h in range(cols):
+                    previousDCs[n], eobs[unit, v, h] = decodeBlock(
+                                    previousDCs[n], dcTableId, acTableId, blocks[unit, v, h])
+
+    # Counts of this interval only, summed up by the caller
+    counts = None
+    if isinstance(intervalDecoder, CountingHuffmanDecoder):
+        counts = intervalDecoder.takeCounts()
+    return results, counts
@@ -1,5 +1,6 @@
 
 from enum import IntEnum
+import numpy as np
 
 class JPG(IntEnum):
 
@@ -108,33 +109,74 @@ class ColorComponent:
     horizontalSamplingFactor: int = 0
     verticalSamplingFactor: int = 0
     quantizationTableID: int = 0
+    # QuantizationTable in effect at the component's first scan, later
+    # redefinitions of its ID do not apply to it
+    qTable = None
     huffmanDCTableID: int = 0
     huffmanACTableID: int = 0
     usedInFrame: bool = False
     usedInScan: bool = False
 
+    # Block grid of this component and its planes, one 64-entry row per block
+    blockHeight: int = 0
+    blockWidth: int = 0
+    # Quantized natural-order coefficients written by the Huffman decoder
+    coeffs: np.ndarray
+    # Dequantized coefficients, transformed to samples and then to R/G/B in place
+    samples: np.ndarray
+    # Zigzag index of the last non-zero coefficient of every block
+    eobs: np.ndarray
+
 class Block:
-    y_r: list = declList(int, 64, 0)
-    cb_g: list = declList(int, 64, 0)
-    cr_b: list = declList(int, 64, 0)
+    # View of block nb across the sample planes, kept so image.blocks[nb][i]
+    # and block.y_r / cb_g / cr_b keep working on top of the planar storage.
+    # nb indexes each component's own block grid, which only lines up
+    # across components for 1x1 sampling
+
+    def __init__(self, image, nb: int) -> None:
+        self.image = image
+        self.nb = nb
 
     def __getitem__(self, i):
         assert i in [0, 1, 2]
-        if i == 0:
-            return self.y_r
-        if i == 1:
-            return self.cb_g
-        if i == 2:
-            return self.cr_b
-        
+        return self.image.colorComponents[i].samples.reshape(-1, 64)[self.nb]
+
     def __setitem__(self, i, l: list):
         assert i in [0, 1, 2]
-        if i == 0:
-            self.y_r = l.copy()
-        if i == 1:
-            self.cb_g = l.copy()
-        if i == 2:
-            self.cr_b = l.copy()
+        self[i][:] = l
+
+    @property
+    def y_r(self):
+        return self[0]
+
+    @property
+    def cb_g(self):
+        return self[1]
+
+    @property
+    def cr_b(self):
+        return self[2]
+
+class BlockList:
+
+    def __init__(self, image) -> None:
+        self.image = image
+
+    def __len__(self):
+        # Size of the luma plane, which may hold a single MCU row when streaming
+        component: ColorComponent = self.image.colorComponents[0]
+        return component.blockHeight * component.blockWidth
+
+    def __getitem__(self, nb: int):
+        if nb < 0:
+            nb += len(self)
+        if nb < 0 or nb >= len(self):
+            raise IndexError(nb)
+        return Block(self.image, nb)
+
+    def __iter__(self):
+        for nb in range(len(self)):
+            yield Block(self.image, nb)
 
 class JPGImage:
     colorComponents: list = declList(ColorComponent, 4)
@@ -153,7 +195,20 @@ class JPGImage:
 
     restartInterval: int = 0
 
-    blocks: list = []
+    # Output is decoded at 1/scale of the frame size, (8 / scale)^2 samples per block
+    scale: int = 1
+
+    # Region of interest: MCU window (row0, row1, col0, col1) held by the
+    # planes, and the (top, left, height, width) crop of it kept in rgb
+    region: tuple = None
+    regionCrop: tuple = None
+
+    blocks: BlockList
+    # (height, width, 3) RGB output of the color conversion
+    rgb: np.ndarray
+
+    # Scans decoded so far, progressive frames have several
+    scanCount: int = 0
 
     valid: bool = True
 
@@ -163,4 +218,116 @@ class JPGImage:
     blockWidthReal: int = 0
 
     horizontalSamplingFactor: int = 0
-    verticalSamplingFactor: int = 0
\ No newline at end of file
+    verticalSamplingFactor: int = 0
+
+    def __init__(self) -> None:
+        self.colorComponents = declList(ColorComponent, 4)
+        self.blocks = BlockList(self)
+
+    @property
+    def blockSize(self):
+        return 8 // self.scale
+
+    @property
+    def outputHeight(self):
+        return (self.height + self.scale - 1) // self.scale
+
+    @property
+    def outputWidth(self):
+        return (self.width + self.scale - 1) // self.scale
+
+    def allocatePlanes(self, mcuRows: int = None, samples: bool = True):
+        # Three sample planes are always present so the R/G/B output of a
+        # grayscale image has somewhere to go, like the old Block lists.
+        # mcuRows limits the planes to a band of MCU rows for streaming,
+        # a region to its MCU window. samples=False leaves out the sample
+        # planes when only the coefficients are wanted
+        mcuCols = self.blockWidthReal // self.horizontalSamplingFactor
+        if self.region is not None:
+            row0, row1, col0, col1 = self.region
+            mcuRows = row1 - row0
+            mcuCols = col1 - col0
+        elif mcuRows is None:
+            mcuRows = self.blockHeightReal // self.verticalSamplingFactor
+
+        for i in range(3):
+            component: ColorComponent = self.colorComponents[i]
+            if i < self.numComponents:
+                component.blockHeight = mcuRows * component.verticalSamplingFactor
+                component.blockWidth = mcuCols * component.horizontalSamplingFactor
+            else:
+                component.blockHeight = mcuRows * self.verticalSamplingFactor
+                component.blockWidth = mcuCols * self.horizontalSamplingFactor
+            shape = (component.blockHeight, component.blockWidth)
+
+            if i < self.numComponents:
+                component.coeffs = np.zeros(shape + (64,), dtype=np.int16)
+            if samples:
+                component.samples = np.zeros(shape + (self.blockSize ** 2,), dtype=np.float64)
+            component.eobs = np.full(shape, 63, dtype=np.int8)
+
+    def computeEobs(self):
+        # Recompute eobs from the coefficients, for progressive frames whose
+        # blocks are filled in over several scans
+        for i in range(self.numComponents):
+            component: ColorComponent = self.colorComponents[i]
+            nonZero = component.coeffs.reshape(-1, 64)[:, zigZagMap] != 0
+            last = 63 - np.argmax(nonZero[:, ::-1], axis=1)
+            last[~nonZero.any(axis=1)] = 0
+            component.eobs.reshape(-1)[:] = last
+
+class JPGHeader:
+    # Header fields of a JPGImage without any of its planes, returned by probe
+
+    def __init__(self, image: JPGImage, quantizationTables: list) -> None:
+        self.frameType = image.frameType
+        self.height = image.height
+        self.width = image.width
+        self.numComponents = image.numComponents
+        self.restartInterval = image.restartInterval
+        # (horizontal, vertical) sampling factors per component
+        self.samplingFactors = [(c.horizontalSamplingFactor, c.verticalSamplingFactor)
+                                for c in image.colorComponents[:image.numComponents]]
+        self.quantizationTableIDs = [c.quantizationTableID for c in image.colorComponents[:image.numComponents]]
+        # Natural-order tables by ID, None where no DQT defined one; a table
+        # latched by a component's first scan wins over a later redefinition
+        quantizationTables = list(quantizationTables)
+        for c in image.colorComponents[:image.numComponents]:
+            if c.qTable is not None:
+                quantizationTables[c.quantizationTableID] = c.qTable
+        self.quantizationTables = [qTable.table if qTable.set else None for qTable in quantizationTables]
+
+    def __repr__(self):
+        return f'JPGHeader({self.width}x{self.height}, {self.numComponents} components, ' \
+               f'sampling {self.samplingFactors}, restart interval {self.restartInterval})'
+
+class JPGCoefficients(JPGHeader):
+    # Quantized coefficients of every component as (blockRows, blockCols, 64)
+    # int16 arrays covering the MCU grid, natural or zigzag order; the
+    # quantization tables are given in the same order
+
+    def __init__(self, image: JPGImage, quantizationTables: list, order: str = 'natural') -> None:
+        assert order in ['natural', 'zigzag'], f'Error - Unknown coefficient order: {order}'
+        super().__init__(image, quantizationTables)
+        self.order = order
+        self.coefficients = [c.coeffs for c in image.colorComponents[:image.numComponents]]
+
+        if order == 'zigzag':
+            self.coefficients = [coeffs[:, :, zigZagMap] for coeffs in self.coefficients]
+            self.quantizationTables = [None if table is None else table[zigZagMap]
+                                       for table in self.quantizationTables]
+
+    def asArrays(self):
+        # Flat name -> array mapping, as saved by np.savez
+        arrays = { f'component{i}': coeffs for i, coeffs in enumerate(self.coefficients) }
+        for i, table in enumerate(self.quantizationTables):
+            if table is not None:
+                arrays[f'quantization{i}'] = table.astype(np.uint16)
+        arrays['quantizationTableIDs'] = np.array(self.quantizationTableIDs, dtype=np.uint8)
+        arrays['samplingFactors'] = np.array(self.samplingFactors, dtype=np.uint8)
+        arrays['size'] = np.array([self.height, self.width], dtype=np.uint32)
+        return arrays
+
+    def __repr__(self):
+        shapes = ', '.join(str(coeffs.shape) for coeffs in self.coefficients)
+        return f'JPGCoefficients({self.width}x{self.height}, {self.order} order, {shapes})'
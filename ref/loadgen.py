@@ -0,0 +1,85 @@
+
+import asyncio
+import time
+from collections import Counter
+import numpy as np
+from server import readMessage, writeMessage
+
+async def connect(host: str, port: int, unixPath: str):
+    if unixPath is not None:
+        return await asyncio.open_unix_connection(unixPath)
+    return await asyncio.open_connection(host, port)
+
+async def request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, options: dict, data: bytes = b''):
+    # Returns (response header, payload)
+    await writeMessage(writer, options, data)
+    header = await readMessage(reader)
+    return header, await reader.readexactly(header.get('size', 0))
+
+async def client(data: bytes, options: dict, requests: list, results: list, address: tuple):
+    # Takes request slots from the shared list until it is empty, one request
+    # in flight per connection
+    reader, writer = await connect(*address)
+    try:
+        while requests:
+            requests.pop()
+            start = time.perf_counter()
+            header, payload = await request(reader, writer, options, data)
+            results.append((time.perf_counter() - start, header['status'], len(payload)))
+    finally:
+        writer.close()
+
+async def runLoad(data: bytes, options: dict, numRequests: int, concurrency: int, address: tuple):
+    requests = list(range(numRequests))
+    results = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(data, options, requests, results, address) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await connect(*address)
+    stats, _ = await request(reader, writer, { 'type': 'stats' })
+    writer.close()
+    return results, elapsed, stats
+
+def printReport(results: list, elapsed: float, dataSize: int, stats: dict):
+    statuses = Counter(status for _, status, _ in results)
+    ok = [(latency, size) for latency, status, size in results if status == 'ok']
+
+    print(f'{len(results)} requests in {elapsed:.2f} s, ' +
+          ', '.join(f'{n} {status}' for status, n in sorted(statuses.items())))
+    if ok:
+        latencies = np.array([latency for latency, _ in ok]) * 1000
+        print(f'latency ok      p50 {np.percentile(latencies, 50):8.2f} ms  p99 {np.percentile(latencies, 99):8.2f} ms  '
+              f'max {latencies.max():8.2f} ms')
+        print(f'throughput      {len(ok) / elapsed:8.2f} req/s  {len(ok) * dataSize / elapsed / (1 << 20):8.2f} MB/s in  '
+              f'{sum(size for _, size in ok) / elapsed / (1 << 20):8.2f} MB/s out')
+    print('server          ' + ', '.join(f'{key} {stats[key]}' for key in
+                                        ['accepted', 'completed', 'failed', 'busy', 'refused', 'timeouts', 'restarts',
+                                         'connections']))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fpath')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', dest='unixPath', metavar='PATH', help='connect to a Unix socket instead')
+    parser.add_argument('-n', '--requests', type=int, default=100, dest='numRequests')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='connections, one request in flight each')
+    parser.add_argument('--scale', type=int, choices=[1, 2, 4, 8], default=1)
+    parser.add_argument('--format', choices=['bmp', 'rgb', 'coefficients'], default='bmp')
+    args = parser.parse_args()
+
+    with open(args.fpath, 'rb') as f:
+        data = f.read()
+        f.close()
+
+    options = { 'format': args.format }
+    if args.format != 'coefficients':
+        options['scale'] = args.scale
+
+    address = (args.host, args.port, args.unixPath)
+    results, elapsed, stats = asyncio.run(runLoad(data, options, args.numRequests, args.concurrency, address))
+    printReport(results, elapsed, len(data), stats)
+    exit(0 if all(status != 'error' for _, status, _ in results) else 1)
@@ -1,9 +1,12 @@
 import numpy as np
 from jpg import *
 from bitreader import *
+from dct import Dct
 
 class QuantizationTable:
     table: np.ndarray
+    # Table premultiplied by the AAN prescale factors, fixed-point mode only
+    prescaled: np.ndarray
     set: bool = False
 
 class Quantization:
@@ -11,69 +14,63 @@ class Quantization:
     br: Bitreader
     quantizationTables: list = declList(QuantizationTable, 4)
 
-    def __init__(self, br: Bitreader) -> None:
+    def __init__(self, br: Bitreader, fractionBits: int = None) -> None:
         self.br = br
+        self.fractionBits = fractionBits
+        self.quantizationTables = declList(QuantizationTable, 4)
+
+    def prescaleTable(self, table: np.ndarray):
+        # Fold the row and column AAN prescale factors into the table so the
+        # fixed-point IDCT starts from dequantized, prescaled coefficients
+        s = np.array([Dct.s0, Dct.s1, Dct.s2, Dct.s3, Dct.s4, Dct.s5, Dct.s6, Dct.s7])
+        factors = np.outer(s, s).reshape(64)
+        return np.round(table * factors * (1 << self.fractionBits)).astype(np.int64)
 
     def readQuantizationTable(self):
-        print('Reading DQT Marker')
 
         length = self.br.readWord()
-        length -= 2
+        assert length >= 2, 'Error - DQT invalid'
+        payload = self.br.readSegment(length - 2)
+        offset = 0
 
-        while length > 0:
-            tableInfo = self.br.readByte()
-            length -= 1
+        while offset < len(payload):
+            tableInfo = payload[offset]
+            offset += 1
             tableID = tableInfo & 0x0f
 
             assert tableID <= 3, f'Error - Invalid quantization table ID: {tableID}'
 
-            qTable: QuantizationTable = self.quantizationTables[tableID]
-            assert not qTable.set
+            # A table may be redefined, e.g. between progressive scans. A new
+            # object replaces the slot, so components that latched the old
+            # one at their first scan keep it
+            qTable = QuantizationTable()
             qTable.set = True
+            self.quantizationTables[tableID] = qTable
+
+            # 16-bit big-endian or 8-bit values in zigzag order
+            dtype = np.dtype('>u2') if (tableInfo >> 4) != 0 else np.dtype(np.uint8)
+            assert offset + 64 * dtype.itemsize <= len(payload), 'Error - DQT invalid'
 
             qTable.table = np.zeros(64)
+            qTable.table[zigZagMap] = np.frombuffer(payload, dtype=dtype, count=64, offset=offset)
+            offset += 64 * dtype.itemsize
 
-            if (tableInfo >> 4) != 0:
-                for i in range(64):
-                    qTable.table[zigZagMap[i]] = self.br.readWord()
-                length -= 128
-            else:
-                for i in range(64):
-                    qTable.table[zigZagMap[i]] = self.br.readByte()
-                length -= 64
+            if self.fractionBits is not None:
+                qTable.prescaled = self.prescaleTable(qTable.table)
 
-    def dequantizeBlockComponent(self, qTable: QuantizationTable, block: list):
-        for i in range(64):
-            block[i] *= qTable.table[i]
+    def componentTables(self, image: JPGImage):
+        # Table of every component: the one latched at its first scan, or the
+        # current definition while no scan has reached it (previews)
+        return [component.qTable if component.qTable is not None
+                else self.quantizationTables[component.quantizationTableID]
+                for component in image.colorComponents[:image.numComponents]]
 
     def dequantize(self, image: JPGImage):
-        if image.verticalSamplingFactor != 1 or image.horizontalSamplingFactor != 1:
-            assert False, 'Not Suported'
-            self.dequantizeSample(image)
-        else:
-            self.dequantizeNoSample(image)
-
-    def dequantizeSample(self, image: JPGImage):
-        for y in range(0, image.blockHeight, image.verticalSamplingFactor):
-            for x in range(0, image.blockWidth, image.horizontalSamplingFactor):
-                for i in range(image.numComponents):
-                    component: ColorComponent = image.colorComponents[i]
-                    for v in range(component.verticalSamplingFactor):
-                        for h in range(component.horizontalSamplingFactor):
-                            block = image.blocks[(y + v) * image.blockWidthReal + (x + h)][i].copy()
-
-                            self.dequantizeBlockComponent(image.quantizationTables[component.quantizationTableID],
-                                                    block)
-                            
-                            image.blocks[(y + v) * image.blockWidthReal + (x + h)][i] = block
-
-    def dequantizeNoSample(self, image: JPGImage):
-        for block in image.blocks:
-            for i in range(image.numComponents):
-                component: ColorComponent = image.colorComponents[i]
-                self.dequantizeBlockComponent(self.quantizationTables[component.quantizationTableID],
-                                                    block[i])
-                
+        # Every component plane is dequantized at its native resolution
+        for i, qTable in enumerate(self.componentTables(image)):
+            component: ColorComponent = image.colorComponents[i]
+            np.multiply(component.coeffs, qTable.table, out=component.samples)
+
     def printInfo(self):
         print("DQT=============")
         for i in range (len(self.quantizationTables)):
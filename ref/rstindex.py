@@ -0,0 +1,141 @@
+
+import os
+import struct
+import numpy as np
+from bitreader import *
+from jpg import *
+
+class RestartIndex:
+    # Where every restart interval of the first scan starts and stops in the
+    # file. Interval k starts with unit k * restartInterval; the tables and
+    # frame state needed to resume are the header bytes before scanStart
+
+    MAGIC = b'RSTI'
+    VERSION = 1
+    # magic, version, file size, mtime (ns), scan start, segment end,
+    # restart interval, number of intervals
+    HEADER = struct.Struct('<4sHQqIIII')
+
+    fileSize: int = 0
+    mtime: int = 0
+    scanStart: int = 0
+    segmentEnd: int = 0
+    restartInterval: int = 0
+    starts: np.ndarray
+    stops: np.ndarray
+
+    def intervals(self):
+        # Same layout as Bitreader.scanRestartMarkers
+        return list(zip(self.starts.tolist(), self.stops.tolist())), self.segmentEnd
+
+    def write(self, fpath):
+        with open(fpath, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.fileSize, self.mtime, self.scanStart,
+                                     self.segmentEnd, self.restartInterval, len(self.starts)))
+            f.write(self.starts.astype('<u4').tobytes())
+            f.write(self.stops.astype('<u4').tobytes())
+            f.close()
+
+    @classmethod
+    def read(cls, fpath):
+        with open(fpath, 'rb') as f:
+            data = f.read()
+            f.close()
+
+        magic, version, fileSize, mtime, scanStart, segmentEnd, restartInterval, count = \
+            cls.HEADER.unpack_from(data)
+        assert magic == cls.MAGIC and version == cls.VERSION, f'Error - Not a restart index: {fpath}'
+        assert len(data) == cls.HEADER.size + 8 * count, f'Error - Truncated restart index: {fpath}'
+
+        index = cls()
+        index.fileSize = fileSize
+        index.mtime = mtime
+        index.scanStart = scanStart
+        index.segmentEnd = segmentEnd
+        index.restartInterval = restartInterval
+        index.starts = np.frombuffer(data, dtype='<u4', count=count, offset=cls.HEADER.size)
+        index.stops = np.frombuffer(data, dtype='<u4', count=count, offset=cls.HEADER.size + 4 * count)
+        return index
+
+def buildIndex(fpath) -> RestartIndex:
+    # One pass over the marker segments up to the first SOS, then over the
+    # entropy-coded data for its RSTn markers; no table is decoded
+    with Bitreader(fpath) as br:
+        st = os.stat(fpath)
+
+        index = RestartIndex()
+        index.fileSize = st.st_size
+        index.mtime = st.st_mtime_ns
+
+        assert br.readByte() == 0xff and br.readByte() == JPG.SOI, 'Error - SOI invalid'
+
+        while True:
+            assert br.readByte() == 0xff, 'Error - Expected a marker'
+            marker = br.readByte()
+            while marker == 0xff:
+                marker = br.readByte()
+
+            assert marker != JPG.EOI, 'Error - EOI detected before SOS'
+
+            if marker == JPG.TEM:
+                continue
+
+            start = br.tell()
+            length = br.readWord()
+            assert length >= 2, f'Error - Invalid segment length: {length}'
+
+            if marker == JPG.DRI:
+                index.restartInterval = br.readWord()
+
+            br.seek(start + length)
+
+            if marker == JPG.SOS:
+                break
+
+        index.scanStart = br.tell()
+        intervals, index.segmentEnd = br.scanRestartMarkers()
+    index.starts = np.array([start for start, _ in intervals], dtype=np.uint32)
+    index.stops = np.array([stop for _, stop in intervals], dtype=np.uint32)
+    return index
+
+# Process-wide cache keyed by (path, size, mtime)
+indexCache: dict = {}
+
+def loadIndex(fpath, sidecar: bool = True) -> RestartIndex:
+    # Memory cache first, then a <fpath>.rsti sidecar that still matches the
+    # file, otherwise index the file and write the sidecar
+    st = os.stat(fpath)
+    key = (os.path.abspath(fpath), st.st_size, st.st_mtime_ns)
+    if key in indexCache:
+        return indexCache[key]
+
+    index = None
+    sidecarPath = fpath + '.rsti'
+    if sidecar and os.path.exists(sidecarPath):
+        index = RestartIndex.read(sidecarPath)
+        if (index.fileSize, index.mtime) != (st.st_size, st.st_mtime_ns):
+            index = None
+
+    if index is None:
+        index = buildIndex(fpath)
+        if sidecar:
+            try:
+                index.write(sidecarPath)
+            except OSError:
+                # Read-only location, keep the in-memory copy only
+                pass
+
+    indexCache[key] = index
+    return index
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fpaths', nargs='+')
+    args = parser.parse_args()
+
+    for fpath in args.fpaths:
+        index = loadIndex(fpath)
+        print(f'{fpath}: {len(index.starts)} intervals of {index.restartInterval} units, '
+              f'scan at {index.scanStart}, ends at {index.segmentEnd}')
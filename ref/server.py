@@ -0,0 +1,232 @@
+
+import asyncio
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from decoder import *
+
+# Every message, in both directions, is a 4-byte big-endian length, a JSON
+# header of that length, then header['size'] payload bytes. Requests carry
+# decode options and the JPEG, responses a status and the output:
+#   request:  { "size": n, "scale": 1, "format": "bmp" | "rgb" | "coefficients", ... }
+#   response: { "status": "ok" | "error" | "busy", "size": n, "width": w, "height": h, ... }
+# A request { "type": "stats" } returns the server counters instead
+MAX_HEADER = 1 << 16
+
+FORMATS = ['bmp', 'rgb', 'coefficients']
+OPTIONS = ['size', 'type', 'format', 'scale', 'idct', 'fractionBits', 'cspace', 'roi', 'order']
+
+async def readMessage(reader: asyncio.StreamReader):
+    # Header only, the caller reads or discards the payload
+    headerLength = int.from_bytes(await reader.readexactly(4), 'big')
+    assert headerLength <= MAX_HEADER, f'Error - Message header too long: {headerLength}'
+    header = json.loads(await reader.readexactly(headerLength))
+    assert isinstance(header, dict), 'Error - Message header is not an object'
+    return header
+
+async def writeMessage(writer: asyncio.StreamWriter, header: dict, payload: bytes = b''):
+    header = dict(header, size=len(payload))
+    data = json.dumps(header).encode()
+    writer.write(len(data).to_bytes(4, 'big') + data)
+    writer.write(payload)
+    await writer.drain()
+
+async def discard(reader: asyncio.StreamReader, size: int):
+    while size > 0:
+        size -= len(await reader.readexactly(min(size, 1 << 16)))
+
+def decodeRequest(data: bytes, options: dict, maxPixels: int):
+    # Runs in a pool worker; returns (response header, payload)
+    try:
+        unknown = set(options) - set(OPTIONS)
+        assert not unknown, f'Error - Unknown options: {sorted(unknown)}'
+        outputFormat = options.get('format', 'bmp')
+        assert outputFormat in FORMATS, f'Error - Unknown output format: {outputFormat}'
+
+        # The planes are sized by the frame header, check it before any is allocated
+        header = probe(data)
+        assert header.width * header.height <= maxPixels, \
+            f'Error - {header.width}x{header.height} frame over the limit of {maxPixels} pixels'
+
+        if outputFormat == 'coefficients':
+            coefficients = readCoefficients(data, options.get('order', 'natural'))
+            buffer = io.BytesIO()
+            np.savez(buffer, **coefficients.asArrays())
+            return { 'status': 'ok', 'format': outputFormat, 'width': coefficients.width,
+                     'height': coefficients.height }, buffer.getvalue()
+
+        roi = options.get('roi')
+        image = readJPG(data, idct=options.get('idct', 'numpy'), fractionBits=options.get('fractionBits'),
+                        cspace=options.get('cspace', 'numpy'), scale=options.get('scale', 1),
+                        roi=None if roi is None else tuple(roi))
+
+        height, width = image.rgb.shape[:2]
+        payload = bytes(Bmp().toBytes(image)) if outputFormat == 'bmp' else image.rgb.tobytes()
+        return { 'status': 'ok', 'format': outputFormat, 'width': width, 'height': height }, payload
+    except Exception as e:
+        # Malformed input fails in many ways besides the decoder's asserts
+        return { 'status': 'error', 'error': str(e) or type(e).__name__ }, b''
+
+class DecodeServer:
+    # Requests of a connection are answered in order, one at a time, so a
+    # client that does not read its responses stops being read from. A
+    # request that would take the number of requests queued or decoding
+    # above maxPending is answered 'busy' at once, payloads above maxBytes
+    # are refused and the connection closed, frames above maxPixels fail
+
+    def __init__(self, workers: int, maxPending: int, maxBytes: int, maxPixels: int,
+                 timeout: float = None) -> None:
+        self.workers = workers
+        self.maxPending = maxPending
+        self.maxBytes = maxBytes
+        self.maxPixels = maxPixels
+        # Seconds a client waits for a decode, None for no limit
+        self.timeout = timeout
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.pending = 0
+        self.counters = { 'accepted': 0, 'busy': 0, 'refused': 0, 'completed': 0, 'failed': 0, 'timeouts': 0,
+                          'restarts': 0, 'connections': 0 }
+        self.started = time.time()
+
+    def stats(self):
+        return dict(self.counters, status='ok', pending=self.pending, workers=self.workers,
+                    maxPending=self.maxPending, uptime=time.time() - self.started)
+
+    async def handleRequest(self, reader: asyncio.StreamReader, header: dict):
+        # Returns (response header, payload, keep the connection)
+        size = header.get('size', 0)
+        if not isinstance(size, int) or size < 0 or size > self.maxBytes:
+            self.counters['refused'] += 1
+            return { 'status': 'error', 'error': f'Error - Payload size {size} over the limit of {self.maxBytes}' }, \
+                b'', False
+
+        if header.get('type') == 'stats':
+            await discard(reader, size)
+            return self.stats(), b'', True
+
+        if self.pending >= self.maxPending:
+            self.counters['busy'] += 1
+            await discard(reader, size)
+            return { 'status': 'busy', 'pending': self.pending }, b'', True
+
+        # Admitted before the payload is read so it counts against the queue
+        self.pending += 1
+        self.counters['accepted'] += 1
+        try:
+            data = await reader.readexactly(size)
+            pool, future = self.submit(data, header)
+        except BaseException:
+            self.pending -= 1
+            raise
+
+        # The slot is given back when the pool job ends. A timed out job
+        # that is already running cannot be cancelled and keeps its worker
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self.jobDone, pool, f))
+
+        try:
+            response, payload = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.counters['timeouts'] += 1
+            response, payload = { 'status': 'error', 'error': f'Error - Decode took over {self.timeout} s' }, b''
+        except BrokenProcessPool:
+            response, payload = { 'status': 'error', 'error': 'Error - Decoder process died' }, b''
+        except Exception as e:
+            response, payload = { 'status': 'error', 'error': str(e) or type(e).__name__ }, b''
+
+        self.counters['completed' if response['status'] == 'ok' else 'failed'] += 1
+        return response, payload, True
+
+    def submit(self, data: bytes, header: dict):
+        # Returns (pool, future); a broken pool is replaced once
+        pool = self.pool
+        try:
+            return pool, pool.submit(decodeRequest, data, header, self.maxPixels)
+        except BrokenProcessPool:
+            self.restartPool(pool)
+            return self.pool, self.pool.submit(decodeRequest, data, header, self.maxPixels)
+
+    def jobDone(self, pool: ProcessPoolExecutor, future):
+        # Also seen for jobs whose client has timed out
+        self.pending -= 1
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self.restartPool(pool)
+
+    def restartPool(self, pool: ProcessPoolExecutor):
+        # A worker died (e.g. killed out of memory) and the executor fails
+        # every job from then on. Replaced once, however many jobs report it
+        if self.pool is pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            self.counters['restarts'] += 1
+
+    async def handleConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.counters['connections'] += 1
+        try:
+            while True:
+                try:
+                    header = await readMessage(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                except (AssertionError, ValueError) as e:
+                    await writeMessage(writer, { 'status': 'error', 'error': str(e) })
+                    break
+
+                try:
+                    response, payload, keep = await self.handleRequest(reader, header)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    raise
+                except Exception as e:
+                    # Where the next message starts is unknown, answer and close
+                    response, payload, keep = { 'status': 'error', 'error': str(e) or type(e).__name__ }, b'', False
+                await writeMessage(writer, response, payload)
+                if not keep:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8765, unixPath: str = None):
+        if unixPath is not None:
+            server = await asyncio.start_unix_server(self.handleConnection, unixPath)
+        else:
+            server = await asyncio.start_server(self.handleConnection, host, port)
+
+        address = unixPath if unixPath is not None else f'{host}:{port}'
+        print(f'Serving on {address} with {self.workers} workers, at most {self.maxPending} pending')
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', dest='unixPath', metavar='PATH', help='listen on a Unix socket instead')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='decoder processes')
+    parser.add_argument('--max-pending', type=int, dest='maxPending',
+                        help='requests queued or decoding before new ones are answered busy (4 per worker)')
+    parser.add_argument('--max-bytes', type=int, default=64 << 20, dest='maxBytes',
+                        help='largest JPEG accepted')
+    parser.add_argument('--max-pixels', type=int, default=1 << 25, dest='maxPixels',
+                        help='largest frame accepted, width x height')
+    parser.add_argument('--timeout', type=float,
+                        help='seconds a client waits for one decode, the worker stays busy until it ends')
+    args = parser.parse_args()
+
+    maxPending = args.maxPending if args.maxPending is not None else 4 * args.workers
+    server = DecodeServer(args.workers, maxPending, args.maxBytes, args.maxPixels, args.timeout)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unixPath))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -0,0 +1,125 @@
+
+import time
+from contextlib import contextmanager
+import numpy as np
+from jpg import *
+from huffman import tableCache
+
+class DecodeStats:
+    # Counters of one decode. Block, symbol, zero-run and EOB figures are
+    # counted by the entropy decoder as it reads, see CountingHuffmanDecoder
+
+    def __init__(self) -> None:
+        # Wall time per stage in seconds
+        self.stageTimes = {}
+        # Markers in file order, by name
+        self.markers = []
+        self.fileBytes = 0
+        # Raw bytes of entropy-coded data decoded, RSTn markers included and
+        # the intervals a region decode skips left out
+        self.entropyBytes = 0
+        # Blocks entropy-decoded, once per scan that codes them, and the
+        # Huffman symbols read for them
+        self.blocks = 0
+        self.symbols = 0
+        # Histogram of AC zero-run lengths between non-zero coefficients,
+        # refinement scans left out
+        self.zeroRuns = np.zeros(63, dtype=np.int64)
+        # Histogram of the zigzag index of the last non-zero coefficient of
+        # sequential blocks
+        self.eobCounts = np.zeros(64, dtype=np.int64)
+        self.kernelCounts = {}
+        # Huffman tables taken from / added to the process-wide table cache
+        self.tableCacheHits = 0
+        self.tableCacheMisses = 0
+
+    @property
+    def entropyBits(self):
+        return 8 * self.entropyBytes
+
+    def asDict(self):
+        return {
+            'stageTimes': dict(self.stageTimes),
+            'markers': list(self.markers),
+            'fileBytes': self.fileBytes,
+            'entropyBytes': self.entropyBytes,
+            'blocks': self.blocks,
+            'symbols': self.symbols,
+            'zeroRuns': self.zeroRuns.tolist(),
+            'eobCounts': self.eobCounts.tolist(),
+            'kernelCounts': dict(self.kernelCounts),
+            'tableCacheHits': self.tableCacheHits,
+            'tableCacheMisses': self.tableCacheMisses,
+        }
+
+class Instrumentation:
+    # Collects DecodeStats for a decode. callback(event, name, value), if
+    # given, is called for every marker ('marker', name, offset), finished
+    # stage ('stage', name, seconds) and at the end ('done', None, stats)
+
+    def __init__(self, callback=None) -> None:
+        self.stats = DecodeStats()
+        self.callback = callback
+        self.cacheCounts = (tableCache.hits, tableCache.misses)
+
+    def notify(self, event: str, name, value):
+        if self.callback is not None:
+            self.callback(event, name, value)
+
+    def marker(self, marker: int, offset: int):
+        name = JPG(marker).name if marker in JPG._value2member_map_ else hex(marker)
+        self.stats.markers.append(name)
+        self.notify('marker', name, offset)
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        self.stats.stageTimes[name] = self.stats.stageTimes.get(name, 0.0) + seconds
+        self.notify('stage', name, seconds)
+
+    def frame(self, decoder):
+        pass
+
+    def scan(self, decoder):
+        pass
+
+    def finish(self, decoder):
+        stats = self.stats
+        stats.blocks, stats.symbols, zeroRuns, eobCounts = decoder.huff.takeCounts()
+        stats.zeroRuns = np.array(zeroRuns, dtype=np.int64)
+        stats.eobCounts = np.array(eobCounts, dtype=np.int64)
+        stats.kernelCounts = dict(decoder.dct.kernelCounts)
+        stats.tableCacheHits = tableCache.hits - self.cacheCounts[0]
+        stats.tableCacheMisses = tableCache.misses - self.cacheCounts[1]
+        self.notify('done', None, stats)
+
+class TraceInstrumentation(Instrumentation):
+    # The decoder's former console tracing: every marker, the frame and
+    # scan tables and the IDCT kernel counts
+
+    def marker(self, marker: int, offset: int):
+        super().marker(marker, offset)
+        print(f'Reading {self.stats.markers[-1]} Marker')
+
+    def frame(self, decoder):
+        decoder.printFrameInfo()
+
+    def scan(self, decoder):
+        decoder.printScanInfo()
+
+    def finish(self, decoder):
+        super().finish(decoder)
+        decoder.dct.printKernelInfo()
+
+def printStats(stats: DecodeStats):
+    for name, seconds in stats.stageTimes.items():
+        print(f'{name}: {seconds * 1000:.2f} ms')
+    print(f'Markers: {" ".join(stats.markers)}')
+    print(f'Entropy-coded data: {stats.entropyBytes} bytes of {stats.fileBytes}')
+    print(f'Blocks: {stats.blocks}, symbols: {stats.symbols}')
+    print(f'Zero runs: {stats.zeroRuns[:16].tolist()} (0-15)')
+    print(f'EOBs: {stats.eobCounts.tolist()}')
+    print(f'IDCT kernels: {stats.kernelCounts}')
+    print(f'Huffman table cache: {stats.tableCacheHits} hits, {stats.tableCacheMisses} misses')
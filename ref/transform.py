@@ -0,0 +1,150 @@
+
+import numpy as np
+from decoder import *
+from encoder import encodeCoefficients
+
+# Sign of every natural-order coefficient of a mirrored block: odd
+# horizontal frequencies change sign in a left-right mirror, odd vertical
+# ones in an up-down mirror
+FLIP_HORIZONTAL = np.tile([1, -1], 32).astype(np.int16)
+FLIP_VERTICAL = np.repeat(np.tile([1, -1], 4), 8).astype(np.int16)
+# Natural-order index of each coefficient of the transposed block
+TRANSPOSE = np.arange(64).reshape(8, 8).T.reshape(64)
+
+class CoefficientFrame:
+    # Quantized coefficients of a frame and what is needed to write them
+    # back: planes laid out as ColorComponent.coeffs and covering the MCU
+    # grid, (horizontal, vertical) sampling factors per component and
+    # natural-order quantization tables by ID
+
+    def __init__(self, planes: list, samplingFactors: list, qTables: list, qTableIDs: list,
+                 height: int, width: int) -> None:
+        self.planes = planes
+        self.samplingFactors = samplingFactors
+        self.qTables = qTables
+        self.qTableIDs = qTableIDs
+        self.height = height
+        self.width = width
+        # Fail instead of trimming partial edge MCUs that a flip would move
+        self.perfect = False
+
+    @property
+    def mcuHeight(self):
+        return 8 * max(v for _, v in self.samplingFactors)
+
+    @property
+    def mcuWidth(self):
+        return 8 * max(h for h, _ in self.samplingFactors)
+
+    def trim(self, height: int, width: int):
+        # Keep the top-left height x width pixels and the MCUs holding them
+        assert 0 < height <= self.height and 0 < width <= self.width, 'Error - Nothing left after trimming'
+        mcuRows = (height + self.mcuHeight - 1) // self.mcuHeight
+        mcuCols = (width + self.mcuWidth - 1) // self.mcuWidth
+        self.planes = [plane[:mcuRows * v, :mcuCols * h] for plane, (h, v) in zip(self.planes, self.samplingFactors)]
+        self.height = height
+        self.width = width
+
+    def trimEdge(self, height: int, width: int):
+        # A partial MCU at the right or bottom edge would end up on the
+        # opposite edge, where it cannot be partial
+        assert not self.perfect or (height, width) == (self.height, self.width), \
+            f'Error - {self.width}x{self.height} is not a multiple of the {self.mcuWidth}x{self.mcuHeight} MCU'
+        self.trim(height, width)
+
+    def flipHorizontal(self):
+        self.trimEdge(self.height, self.width // self.mcuWidth * self.mcuWidth)
+        self.planes = [plane[:, ::-1] * FLIP_HORIZONTAL for plane in self.planes]
+
+    def flipVertical(self):
+        self.trimEdge(self.height // self.mcuHeight * self.mcuHeight, self.width)
+        self.planes = [plane[::-1] * FLIP_VERTICAL for plane in self.planes]
+
+    def transpose(self):
+        # Block grid, blocks, sampling factors and quantization tables are
+        # all transposed; the top-left corner stays, so nothing is trimmed
+        self.planes = [plane.transpose(1, 0, 2)[:, :, TRANSPOSE] for plane in self.planes]
+        self.samplingFactors = [(v, h) for h, v in self.samplingFactors]
+        self.qTables = [None if table is None else table.reshape(8, 8).T.reshape(64) for table in self.qTables]
+        self.height, self.width = self.width, self.height
+
+    def transverse(self):
+        # Transpose across the anti-diagonal
+        self.rotate(180)
+        self.transpose()
+
+    def rotate(self, degrees: int):
+        # Clockwise
+        assert degrees in [90, 180, 270], f'Error - Unsupported rotation: {degrees}'
+        if degrees == 90:
+            self.transpose()
+            self.flipHorizontal()
+        elif degrees == 180:
+            self.flipHorizontal()
+            self.flipVertical()
+        else:
+            self.transpose()
+            self.flipVertical()
+
+    def crop(self, x: int, y: int, width: int, height: int):
+        # x and y are moved back to an MCU boundary, the rectangle grows to
+        # keep its bottom-right corner
+        assert width > 0 and height > 0 and x >= 0 and y >= 0 and \
+            x + width <= self.width and y + height <= self.height, \
+            f'Error - Crop outside the image: {(x, y, width, height)}'
+
+        row0 = y // self.mcuHeight
+        col0 = x // self.mcuWidth
+        self.planes = [plane[row0 * v:, col0 * h:] for plane, (h, v) in zip(self.planes, self.samplingFactors)]
+        self.height -= row0 * self.mcuHeight
+        self.width -= col0 * self.mcuWidth
+        self.trim(y + height - row0 * self.mcuHeight, x + width - col0 * self.mcuWidth)
+
+    def encode(self, restartInterval: int = 0, optimize: bool = False):
+        planes = [np.ascontiguousarray(plane, dtype=np.int16) for plane in self.planes]
+        return encodeCoefficients(planes, self.samplingFactors, self.qTables, self.qTableIDs,
+                                  self.height, self.width, restartInterval, optimize)
+
+def loadCoefficients(fpath: str) -> CoefficientFrame:
+    # Huffman decoding only: no dequantization, IDCT or color conversion
+    c = readCoefficients(fpath)
+    return CoefficientFrame(c.coefficients, c.samplingFactors, c.quantizationTables, c.quantizationTableIDs,
+                            c.height, c.width)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fpath')
+    parser.add_argument('outpath')
+    parser.add_argument('--rotate', type=int, choices=[90, 180, 270], help='clockwise')
+    parser.add_argument('--flip', choices=['horizontal', 'vertical'])
+    parser.add_argument('--transpose', action='store_true')
+    parser.add_argument('--transverse', action='store_true')
+    parser.add_argument('--crop', type=int, nargs=4, metavar=('X', 'Y', 'W', 'H'),
+                        help='crop after the other transforms, X and Y snap to MCU boundaries')
+    parser.add_argument('--perfect', action='store_true',
+                        help='fail instead of trimming partial edge MCUs')
+    parser.add_argument('--optimize', action='store_true', help='fit the Huffman tables to the output')
+    parser.add_argument('--restart-interval', type=int, default=0, dest='restartInterval')
+    args = parser.parse_args()
+
+    frame = loadCoefficients(args.fpath)
+    frame.perfect = args.perfect
+
+    if args.transpose:
+        frame.transpose()
+    if args.transverse:
+        frame.transverse()
+    if args.rotate is not None:
+        frame.rotate(args.rotate)
+    if args.flip == 'horizontal':
+        frame.flipHorizontal()
+    elif args.flip == 'vertical':
+        frame.flipVertical()
+    if args.crop is not None:
+        frame.crop(*args.crop)
+
+    with open(args.outpath, 'wb') as f:
+        f.write(frame.encode(args.restartInterval, args.optimize))
+        f.close()